@@ -0,0 +1,107 @@
+"""Display values of nodes, computed once when the repository is loaded so
+that templates only need to read them
+
+"""
+import re
+
+import littlechef
+
+from kitchen.settings import REPO, TAG_CLASSES
+
+
+def get_role_list(run_list):
+    """Returns the role sublist from the given run_list"""
+    role_list = []
+    for role in littlechef.lib.get_roles_in_node({'run_list': run_list or []}):
+        if not role.startswith(REPO['EXCLUDE_ROLE_PREFIX']):
+            # Only add if it doesn't start with excluded role prefixes
+            role_list.append(role)
+    return role_list
+
+
+def get_recipe_list(run_list):
+    """Returns the recipe sublist from the given run_list"""
+    return littlechef.lib.get_recipes_in_node({'run_list': run_list or []})
+
+
+def get_memory_in_GB(memory_str):
+    """Returns the memory value in GB from a given string in kB"""
+    try:
+        return '{0} GB'.format(int(memory_str[:-2]) / 1000000)
+    except (ValueError, TypeError):
+        return ''
+
+
+def get_cpus(cpus):
+    """Returns the number of CPUs, or '-' when unknown"""
+    return cpus if cpus is not None else "-"
+
+
+class TagMatcher(object):
+    """Resolves tags to button classes. Keys ending with '*' match the tags
+    starting with the rest of the key, the longest one taking precedence.
+    All wildcard keys are matched by a single compiled pattern
+
+    """
+    def __init__(self, tag_classes):
+        self.classes = dict(tag_classes)
+        self.prefix_classes = {}
+        for key, btn_class in tag_classes.iteritems():
+            if key.endswith("*"):
+                self.prefix_classes[key[:-1]] = btn_class
+        prefixes = sorted(self.prefix_classes, key=len, reverse=True)
+        self.pattern = None
+        if prefixes:
+            self.pattern = re.compile(
+                '|'.join(re.escape(prefix) for prefix in prefixes))
+
+    def get_class(self, tag):
+        """Returns the button class of the given tag"""
+        btn_class = self.classes.get(tag, "")
+        if btn_class == "" and self.pattern is not None:
+            match = self.pattern.match(tag)
+            if match is not None:
+                return self.prefix_classes[match.group()]
+        return btn_class
+
+
+tag_matcher = TagMatcher(TAG_CLASSES)
+
+# Settings the display values depend on
+DISPLAY_SETTINGS = (REPO['EXCLUDE_ROLE_PREFIX'],
+                    tuple(sorted(TAG_CLASSES.items())))
+
+
+def _get_total(value):
+    """Returns the total of an ohai 'memory' or 'cpu' tree"""
+    if isinstance(value, dict):
+        return value.get('total')
+    return None
+
+
+class NodeDisplay(object):
+    """Values the list and virt views show for a node: its visible roles,
+    its recipes, memory in GB, number of CPUs and (tag, button class) pairs
+
+    """
+    __slots__ = ('roles', 'recipes', 'memory', 'cpus', 'tags')
+
+    def __init__(self, node):
+        run_list = node.get('run_list')
+        self.roles = get_role_list(run_list)
+        self.recipes = get_recipe_list(run_list)
+        self.memory = get_memory_in_GB(_get_total(node.get('memory')))
+        self.cpus = get_cpus(_get_total(node.get('cpu')))
+        self.tags = [(tag, tag_matcher.get_class(tag))
+                     for tag in node.get('tags') or []]
+
+
+def get_display(node):
+    """Returns the display values of a node, computing them when the node
+    doesn't carry them
+
+    """
+    display = node.get('display')
+    if display is None:
+        display = NodeDisplay(node)
+    return display
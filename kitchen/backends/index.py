@@ -0,0 +1,206 @@
+"""Indexes over repository nodes, built once per repository load"""
+import copy
+
+from kitchen.backends.display import NodeDisplay, get_display
+from kitchen.backends.records import NodeRecord, get_digest, get_node_digest
+
+
+def _copy_node(node):
+    """Returns a dict copy of a node. Only the hot fields of node records are
+    copied
+
+    """
+    if isinstance(node, NodeRecord):
+        return node.hot_fields()
+    return dict(node)
+
+
+def _expand_node(node):
+    """Returns a full attribute tree copy of a node or node record"""
+    if isinstance(node, NodeRecord):
+        return node.attributes()
+    return copy.deepcopy(node)
+
+
+def _copy_derived(source, target, fields):
+    """Copies the given derived fields from source to target, when set"""
+    for field in fields:
+        if field in source:
+            target[field] = source[field]
+
+
+# Values hosts and guest entries carry besides the node attributes
+HOST_DERIVED_FIELDS = ('display', 'digest', 'block_digest', 'guest_memory')
+GUEST_DERIVED_FIELDS = ('display', 'digest')
+
+
+class NodeIndex(object):
+    """Inverted indexes mapping environments, role prefixes, virtualization
+    roles and tags to the positions of the nodes that have them
+
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.by_env = {}
+        self.by_role_prefix = {}
+        self.by_virt_role = {}
+        self.by_tag = {}
+        for i, node in enumerate(nodes):
+            env = node.get('chef_environment', 'none')
+            self.by_env.setdefault(env, set()).add(i)
+            for role in node.get('roles', []):
+                self.by_role_prefix.setdefault(
+                    role.split("_")[0], set()).add(i)
+            virt_role = node.get('virtualization', {}).get('role')
+            self.by_virt_role.setdefault(virt_role, set()).add(i)
+            for tag in node.get('tags') or []:
+                self.by_tag.setdefault(tag, set()).add(i)
+
+    def _union(self, index, keys):
+        """Returns the positions of nodes found in the index under any of
+        the given keys
+
+        """
+        positions = set()
+        for key in keys:
+            positions.update(index.get(key, ()))
+        return positions
+
+    def filter_ids(self, env='', roles=None, virt_roles='', tags=None):
+        """Returns the sorted positions of the nodes which fulfill env,
+        roles, virt_roles and tags criteria
+
+        """
+        selections = []
+        if env:
+            selections.append(self.by_env.get(env, set()))
+        if roles:
+            selections.append(self._union(self.by_role_prefix, roles))
+        if virt_roles:
+            if isinstance(virt_roles, basestring):
+                virt_roles = virt_roles.split(',')
+            selection = self._union(self.by_virt_role, virt_roles)
+            if 'guest' in virt_roles:
+                # Nodes without a virtualization role are considered guests
+                for virt_role, positions in self.by_virt_role.iteritems():
+                    if not virt_role:
+                        selection.update(positions)
+            selections.append(selection)
+        if tags:
+            selections.append(self._union(self.by_tag, tags))
+        if not selections:
+            return range(len(self.nodes))
+        selections.sort(key=len)
+        positions = selections[0].intersection(*selections[1:])
+        return sorted(positions)
+
+    def filter(self, env='', roles=None, virt_roles='', tags=None):
+        """Returns the nodes which fulfill env, roles, virt_roles and tags
+        criteria, in repository order
+
+        """
+        return [self.nodes[i]
+                for i in self.filter_ids(env, roles, virt_roles, tags)]
+
+
+def _get_memory_in_kB(node):
+    """Returns the total memory of a node in kB, or 0 when unknown"""
+    try:
+        return int(node['memory']['total'].replace("kB", ''))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return 0
+
+
+class HostTopology(object):
+    """Virtualization hosts grouped with their guests, which are matched to
+    the hosts' 'virtualization/guests' entries by fqdn. Built out of node
+    records, hosts and guest entries only hold the records' hot fields.
+    All of them carry the display values of their merged fields. Hosts also
+    carry a 'block_digest' of their own and their guest nodes' content, and
+    the 'guest_memory' their guest entries list, in kB
+
+    """
+    def __init__(self, nodes, index):
+        self.nodes = nodes
+        self.index = index
+        # Host copies whose guest entries include the guest node attributes
+        self.hosts = []
+        # Maps node positions to the hosts they belong to
+        self._hosts_of = {}
+        # Maps guest positions to the name of the first host they run on
+        self.host_of = {}
+        # Positions of the host and guest nodes each host was built from
+        self._sources = []
+        self._numbers_by_name = {}
+        guests_by_fqdn = {}
+        for i in index.filter_ids(virt_roles='guest'):
+            fqdn = nodes[i].get('fqdn')
+            if fqdn is not None:
+                guests_by_fqdn.setdefault(fqdn, i)
+        for i in index.filter_ids(virt_roles='host'):
+            host_number = len(self.hosts)
+            self._hosts_of.setdefault(i, set()).add(host_number)
+            host = _copy_node(nodes[i])
+            host['display'] = get_display(host)
+            host['virtualization'] = dict(host['virtualization'])
+            digests = [get_node_digest(nodes[i])]
+            host['guest_memory'] = 0
+            guest_ids = []
+            if 'guests' in host['virtualization']:
+                vms = []
+                for vm in host['virtualization']['guests']:
+                    host['guest_memory'] += _get_memory_in_kB(vm)
+                    guest = guests_by_fqdn.get(vm.get('fqdn'))
+                    guest_ids.append(guest)
+                    vm = dict(vm)
+                    if guest is not None:
+                        digests.append(get_node_digest(nodes[guest]))
+                        vm.update(_copy_node(nodes[guest]))  # Add guest
+                        self._hosts_of.setdefault(guest, set()).add(
+                            host_number)
+                        self.host_of.setdefault(guest, host['name'])
+                    # Guest entries may add values to the guest node's
+                    vm['display'] = NodeDisplay(vm)
+                    vms.append(vm)
+                host['virtualization']['guests'] = vms
+            host['block_digest'] = get_digest(u'\n'.join(digests))
+            self.hosts.append(host)
+            self._sources.append((i, guest_ids))
+            self._numbers_by_name.setdefault(host['name'], host_number)
+
+    def group(self, roles=None, env=''):
+        """Returns the hosts which themselves or at least one of their guests
+        belong to the given environment and have the given roles
+
+        """
+        if not roles and not env:
+            return list(self.hosts)
+        host_numbers = set()
+        for i in self.index.filter_ids(env, roles):
+            host_numbers.update(self._hosts_of.get(i, ()))
+        return [self.hosts[n] for n in sorted(host_numbers)]
+
+    def expand(self, hosts):
+        """Returns copies of the given hosts and their guest entries holding
+        the full attribute trees of the nodes they were built from, instead
+        of only their hot fields, along with their derived values
+
+        """
+        expanded = []
+        for host in hosts:
+            number = self._numbers_by_name.get(host.get('name'))
+            if number is None or self.hosts[number] is not host:
+                expanded.append(copy.deepcopy(host))  # Not built here
+                continue
+            host_id, guest_ids = self._sources[number]
+            full_host = _expand_node(self.nodes[host_id])
+            _copy_derived(host, full_host, HOST_DERIVED_FIELDS)
+            if guest_ids:
+                guests = full_host['virtualization']['guests']
+                for vm, guest, guest_id in zip(
+                        guests, host['virtualization']['guests'], guest_ids):
+                    if guest_id is not None:
+                        vm.update(_expand_node(self.nodes[guest_id]))
+                    _copy_derived(guest, vm, GUEST_DERIVED_FIELDS)
+            expanded.append(full_host)
+        return expanded
@@ -1,18 +1,44 @@
 """Functions to read and process data from a LittleChef repository"""
 import os
+import copy
+import functools
+import cPickle as pickle
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 import simplejson as json
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
-from littlechef import runner, lib, chef
+import littlechef
+from littlechef import lib, chef
 from logbook import Logger
 
-from kitchen.settings import REPO, REPO_BASE_PATH
+from kitchen.settings import (REPO, REPO_BASE_PATH, SYNCDATE_FILE,
+                              SNAPSHOT_FILE, NODE_STORE_FILE)
+from kitchen.backends import reader
 from kitchen.backends.plugins import plugins
+from kitchen.backends.index import NodeIndex, HostTopology
+from kitchen.backends.sqlstore import NodeStore
+from kitchen.backends.records import NodeRecord, node_json
+from kitchen.backends.display import DISPLAY_SETTINGS
 
 log = Logger(__name__)
 
 KITCHEN_DIR = os.path.join(
     REPO_BASE_PATH, REPO['NAME'], REPO['KITCHEN_SUBDIR'])
 DATA_BAG_PATH = os.path.join(KITCHEN_DIR, "data_bags", "node")
+# Data bag items are read in parallel when there are at least this many
+BULK_LOAD_MIN_ITEMS = 64
+BULK_LOAD_THREADS = 8
+# Bump whenever the pickled RepoSnapshot structure changes
+SNAPSHOT_FORMAT_VERSION = 7
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_node_stores = {}
 
 
 class RepoError(Exception):
@@ -25,10 +51,7 @@ def _check_kitchen():
     if not os.path.exists(KITCHEN_DIR):
         raise RepoError("Repo dir doesn't exist at '{0}'".format(KITCHEN_DIR))
 
-    current_dir = os.getcwd()
-    os.chdir(KITCHEN_DIR)
-    in_a_kitchen, missing = runner._check_appliances()
-    os.chdir(current_dir)
+    in_a_kitchen, missing = reader.check_appliances(KITCHEN_DIR)
     if not in_a_kitchen:
         missing_str = lambda m: ' and '.join(', '.join(m).rsplit(', ', 1))
         raise RepoError("Couldn't find {0}. ".format(missing_str(missing)))
@@ -39,7 +62,10 @@ def _check_kitchen():
 
 
 def build_node_data_bag():
-    """Tells LittleChef to build the node data bag"""
+    """Tells LittleChef to build the node data bag. Returns whether it was
+    built
+
+    """
     current_dir = os.getcwd()
     os.chdir(KITCHEN_DIR)
     try:
@@ -47,8 +73,129 @@ def build_node_data_bag():
         chef.build_node_data_bag()
     except SystemExit as e:
         log.error(e)
+        return False
     finally:
         os.chdir(current_dir)
+        invalidate_snapshot()
+    return True
+
+
+def _classify_changed_files(changed_files):
+    """Groups the given kitchen relative file paths by the kind of item they
+    belong to: nodes, roles, environments and cookbooks
+
+    """
+    changed = {'nodes': set(), 'roles': set(), 'environments': set(),
+               'cookbooks': set()}
+    for path in changed_files:
+        parts = path.split('/')
+        if len(parts) < 2:
+            continue
+        if parts[0] in ('nodes', 'roles', 'environments'):
+            if parts[-1].endswith('.json'):
+                changed[parts[0]].add(
+                    '/'.join(parts[1:])[:-len('.json')])
+        elif parts[0] in littlechef.cookbook_paths and len(parts) > 2:
+            changed['cookbooks'].add(parts[1])
+    return changed
+
+
+def _get_role_from(roles, name):
+    """Returns the given role from a dict of roles by full name, falling
+    back to reading it from disk
+
+    """
+    role = roles.get(name)
+    if role is None:
+        role = reader.get_role(KITCHEN_DIR, name)
+    return role
+
+
+def _expand_node(node, roles):
+    """Adds the data bag id and the extended role and recipe lists to a node
+    the same way LittleChef does when building the node data bag
+
+    """
+    node['id'] = node['name'].replace('.', '_')
+    node['role'] = lib.get_roles_in_node(node)
+    node['roles'] = node['role'][:]
+    for role in node['role']:
+        node['roles'].extend(
+            lib.get_roles_in_node(_get_role_from(roles, role)))
+    node['roles'] = list(set(node['roles']))
+    node['recipes'] = lib.get_recipes_in_node(node)
+    for role in node['roles']:
+        node['recipes'].extend(
+            lib.get_recipes_in_node(_get_role_from(roles, role)))
+    node['recipes'] = list(set(node['recipes']))
+
+
+def _is_node_affected(node, changed):
+    """Checks whether the node data bag item depends on any changed file"""
+    if node['name'] in changed['nodes']:
+        return True
+    if node.get('chef_environment') in changed['environments']:
+        return True
+    if changed['roles'].intersection(node['roles']):
+        return True
+    for recipe in node['recipes']:
+        if recipe.split('::')[0] in changed['cookbooks']:
+            return True
+    return False
+
+
+def update_node_data_bag(changed_files):
+    """Rebuilds only the node data bag items affected by the given changed
+    files, whose paths are relative to the kitchen. Metadata is only
+    regenerated for touched cookbooks. Does a full build when the data bag
+    doesn't exist yet. Returns whether the affected items were rebuilt
+
+    """
+    if not os.path.exists(DATA_BAG_PATH):
+        return build_node_data_bag()
+    changed = _classify_changed_files(changed_files)
+    if not any(changed.values()):
+        log.info("No changes affecting the node data bag")
+        return True
+    try:
+        for cookbook in changed['cookbooks']:
+            if any(os.path.isdir(os.path.join(KITCHEN_DIR, path, cookbook))
+                   for path in littlechef.cookbook_paths):
+                # Builds metadata.json
+                reader.get_recipes_in_cookbook(KITCHEN_DIR, cookbook)
+        all_roles = reader.get_roles(KITCHEN_DIR)
+        roles = dict((role['fullname'], role) for role in all_roles)
+        nodes = reader.get_nodes(KITCHEN_DIR)
+        affected = []
+        for node in nodes:
+            _expand_node(node, roles)
+            if _is_node_affected(node, changed):
+                affected.append(node)
+        # Remove items of deleted nodes
+        existing = set(node['name'] for node in nodes)
+        for name in changed['nodes'] - existing:
+            item = os.path.join(DATA_BAG_PATH,
+                                name.replace('.', '_') + '.json')
+            if os.path.exists(item):
+                os.remove(item)
+        all_recipes = []
+        cookbooks = set(recipe.split('::')[0]
+                        for node in affected for recipe in node['recipes'])
+        for cookbook in cookbooks:
+            all_recipes.extend(
+                reader.get_recipes_in_cookbook(KITCHEN_DIR, cookbook))
+        for node in affected:
+            chef._add_merged_attributes(node, all_recipes, all_roles)
+            chef._add_automatic_attributes(node)
+            with open(os.path.join(
+                    DATA_BAG_PATH, node['id'] + '.json'), 'w') as f:
+                f.write(json.dumps(node))
+        log.info("Rebuilt {0} node data bag items".format(len(affected)))
+    except (IOError, ValueError) as e:
+        log.error(e)
+        return False
+    finally:
+        invalidate_snapshot()
     return True
 
 
@@ -65,23 +212,22 @@ def get_environments(nodes):
 
 
 def _data_loader(data_type, name=None):
-    """Loads data from LittleChef's kitchen"""
-    current_dir = os.getcwd()
-    os.chdir(KITCHEN_DIR)
+    """Loads data from the kitchen. Reads files using absolute paths, so that
+    the working directory is never changed
+
+    """
+    func = getattr(reader, "get_" + data_type)
     try:
-        func = getattr(lib, "get_" + data_type)
         if name:
-            data = func(name)
+            data = func(KITCHEN_DIR, name)
         else:
-            data = func()
-    except SystemExit as e:
+            data = func(KITCHEN_DIR)
+    except ValueError as e:
         log.error(e)
         raise RepoError('Error while loading {0} files. Possibly a JSON '
                         'syntax error'.format(data_type))
     else:
         return data
-    finally:
-        os.chdir(current_dir)
 
 
 def _load_data(data_type, name=None):
@@ -93,25 +239,49 @@ def _load_data(data_type, name=None):
     return _data_loader(data_type, name)
 
 
-def _load_extended_node_data(nodes):
-    """Loads JSON node files from node databag, which has merged attributes"""
-    data = []
+def _read_data_bag_item(filepath, as_record=False):
+    """Reads and parses a node data bag item, optionally as a NodeRecord"""
+    with open(filepath, 'r') as f:
+        content = f.read()
+    try:
+        node = json_loads(content)
+    except ValueError as e:
+        error = 'LittleChef found the following error in'
+        error += ' "{0}":\n {1}'.format(filepath, str(e))
+        raise RepoError(error)
+    if as_record:
+        return NodeRecord(content, node)
+    return node
+
+
+def _load_extended_node_data(nodes, as_records=False):
+    """Loads JSON node files from node databag, which has merged attributes.
+    The data bag directory is listed once and big data bags are read by a
+    pool of threads. Returns compact NodeRecords when as_records is True
+
+    """
+    try:
+        items = set(os.listdir(DATA_BAG_PATH))
+    except OSError:
+        items = set()
+    filepaths = []
     for node in nodes:
         # Read corresponding data bag item for each node
         filename = node['name'].replace(".", "_") + ".json"
-        filepath = os.path.join(DATA_BAG_PATH, filename)
-        if not os.path.exists(filepath):
+        if filename not in items:
             error = "'node' data bag was not generated correctly: item "
             error += "'data_bag/node/{0}' is missing".format(filename)
             raise RepoError(error)
-        with open(filepath, 'r') as f:
-            try:
-                data.append(json.loads(f.read()))
-            except json.JSONDecodeError as e:
-                error = 'LittleChef found the following error in'
-                error += ' "{0}":\n {1}'.format(filepath, str(e))
-                raise RepoError(error)
-    return data
+        filepaths.append(os.path.join(DATA_BAG_PATH, filename))
+    read_item = functools.partial(_read_data_bag_item, as_record=as_records)
+    if len(filepaths) < BULK_LOAD_MIN_ITEMS:
+        return [read_item(filepath) for filepath in filepaths]
+    pool = ThreadPool(BULK_LOAD_THREADS)
+    try:
+        chunksize = max(1, len(filepaths) // (BULK_LOAD_THREADS * 4))
+        return pool.map(read_item, filepaths, chunksize)
+    finally:
+        pool.terminate()
 
 
 def inject_plugin_data(nodes):
@@ -125,48 +295,71 @@ def inject_plugin_data(nodes):
                 continue
 
 
+def expand_nodes(nodes):
+    """Returns the full attribute trees of the given nodes, decoding compact
+    node records
+
+    """
+    return [node.attributes() if isinstance(node, NodeRecord) else node
+            for node in nodes]
+
+
+def _expand_record(record):
+    """Returns the full attribute tree of a node record along with its
+    display values and digest
+
+    """
+    node = record.attributes()
+    node['display'] = record.display
+    node['digest'] = record.digest
+    return node
+
+
+def with_plugin_data(nodes, topology=None):
+    """Returns the given nodes with kitchen plugin data injected.
+    Nodes are copied before injecting, as they may belong to the shared
+    repository snapshot, and node records are decoded into full attribute
+    trees which keep their display values and digest. Hosts grouped by the
+    given HostTopology are expanded by it. Without enabled plugins they are
+    returned as is
+
+    """
+    if not plugins:
+        return nodes
+    if topology is not None:
+        nodes = topology.expand(nodes)
+    else:
+        nodes = [_expand_record(node) if isinstance(node, NodeRecord)
+                 else copy.deepcopy(node) for node in nodes]
+    inject_plugin_data(nodes)
+    return nodes
+
+
 def group_nodes_by_host(nodes, roles='', env=''):
     """Returns a list of hosts with their virtual machines
     Hosts will only be returned if they or at least one of their guests belong
     to the specified environment and have assigned the specified roles.
+    The given nodes are not modified, returned hosts are copies
 
     """
-    hosts = filter_nodes(nodes, virt_roles='host')
-    guests = filter_nodes(nodes, virt_roles='guest')
-    filtered_hosts = []
-
-    for host in hosts:
-        append = False
-        if filter_nodes([host], roles=roles, env=env):
-            append = True
-        for vm in host['virtualization'].get('guests', []):
-            for guest in guests:
-                if guest['fqdn'] == vm['fqdn']:
-                    vm.update(guest)  # Add guest attributes to the vm
-                    if filter_nodes([guest], roles=roles, env=env):
-                        append = True
-                    break
-        if append:
-            filtered_hosts.append(host)
-    return filtered_hosts
+    return HostTopology(nodes, NodeIndex(nodes)).group(roles, env)
 
 
 def filter_nodes(nodes, env='', roles=None, virt_roles=''):
     """Returns nodes which fulfill env, roles and virt_roles criteria"""
     retval = []
-    if not roles:
-        roles = []
+    roles = set(roles or [])
     if virt_roles:
         virt_roles = virt_roles.split(',')
     for node in nodes:
-        append = True
         if env and node.get('chef_environment', 'none') != env:
-            append = False
+            continue
         if roles:
-            if not set.intersection(
-                    set(roles),
-                    set([role.split("_")[0] for role in node['roles']])):
-                append = False
+            for role in node['roles']:
+                if role.split("_")[0] in roles:
+                    break
+            else:
+                continue
         if virt_roles:
             # Exclude node in two cases:
             #   * the virtualization role is not in the desired virt_roles
@@ -175,9 +368,8 @@ def filter_nodes(nodes, env='', roles=None, virt_roles=''):
             virt_role = node.get('virtualization', {}).get('role')
             if not virt_role in virt_roles and \
                     not ('guest' in virt_roles and not virt_role):
-                append = False
-        if append:
-            retval.append(node)
+                continue
+        retval.append(node)
     return retval
 
 
@@ -216,3 +408,284 @@ def get_role_groups(roles):
         if split[0] != REPO['EXCLUDE_ROLE_PREFIX']:
             groups.add(split[0])
     return sorted(groups)
+
+
+def _get_git_head(path):
+    """Returns the commit id checked out by the git repository containing the
+    given path, or None when it can't be determined
+
+    """
+    git_dir = None
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            git_dir = candidate
+            break
+        elif os.path.isfile(candidate):
+            # Worktrees and submodules point to the real git dir
+            with open(candidate, 'r') as f:
+                content = f.read().strip()
+            if content.startswith('gitdir:'):
+                git_dir = os.path.join(path, content[len('gitdir:'):].strip())
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    if git_dir is None:
+        return None
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            return head  # Detached HEAD
+        ref = head[len('ref:'):].strip()
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path, 'r') as f:
+                return f.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split(' ', 1)[0]
+    except IOError:
+        pass
+    return None
+
+
+def get_repo_generation():
+    """Returns an identifier for the current state of the repository, built
+    out of its location, its git HEAD and the last sync date
+
+    """
+    try:
+        sync_date = os.stat(SYNCDATE_FILE).st_mtime
+    except OSError:
+        sync_date = None
+    return KITCHEN_DIR, _get_git_head(KITCHEN_DIR), sync_date
+
+
+class RepoSnapshot(object):
+    """In-memory copy of the repository data for a given generation.
+    Extended nodes are kept as compact NodeRecords. Its contents are shared
+    between requests and must not be modified
+
+    """
+    def __init__(self, generation, nodes, nodes_extended, roles):
+        self.generation = generation
+        self.nodes = nodes
+        self.nodes_extended = nodes_extended
+        self.roles = roles
+        self.role_groups = get_role_groups(roles)
+        self.environments = get_environments(nodes_extended)
+        self.index = NodeIndex(nodes_extended)
+        self.topology = HostTopology(nodes_extended, self.index)
+        self._nodes_by_name = dict(
+            (node['name'], node) for node in nodes)
+        self._init_cache()
+
+    def _init_cache(self):
+        """Sets up the store of values derived from the snapshot"""
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cache']
+        del state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def get_cached(self, key, build):
+        """Returns the value derived from the snapshot stored under key,
+        calling build() to obtain it the first time it is requested
+
+        """
+        with self._cache_lock:
+            if key in self._cache:
+                return self._cache[key]
+        value = build()
+        with self._cache_lock:
+            return self._cache.setdefault(key, value)
+
+    def has_environment(self, env):
+        """Returns whether any node belongs to the given environment"""
+        return env in self.index.by_env
+
+    def get_node(self, name):
+        """Returns the given node, or None when it doesn't exist"""
+        return self._nodes_by_name.get(name)
+
+    def get_node_digest(self, name):
+        """Returns the digest of the given node's extended data, or None when
+        it doesn't exist
+
+        """
+        digests = self.get_cached('node_digests', lambda: dict(
+            (node['name'], node['digest']) for node in self.nodes_extended))
+        return digests.get(name)
+
+    def filter_nodes(self, env='', roles=None, virt_roles='', extended=True):
+        """Returns the extended or plain nodes which fulfill env, roles and
+        virt_roles criteria, using the node index
+
+        """
+        nodes = self.nodes_extended if extended else self.nodes
+        return [nodes[i]
+                for i in self.index.filter_ids(env, roles, virt_roles)]
+
+
+def _load_snapshot(generation):
+    """Reads all repository data into a new snapshot"""
+    roles = get_roles()
+    nodes = get_nodes()
+    nodes_extended = _load_extended_node_data(nodes, as_records=True)
+    log.debug("Loaded repository snapshot {0}".format(generation))
+    return RepoSnapshot(generation, nodes, nodes_extended, roles)
+
+
+def write_snapshot_file(path=None, sync_date=None):
+    """Writes a snapshot of the current repository generation to a file,
+    replacing the previous one atomically. The file starts with a header
+    holding the format version, the generation and the settings node display
+    values depend on, followed by the pickled snapshot. With sync_date, the
+    snapshot is written for the generation the repository will have once its
+    sync date is set to it
+
+    """
+    path = path or SNAPSHOT_FILE
+    generation = get_repo_generation()
+    if sync_date is not None:
+        generation = generation[:2] + (sync_date,)
+    snapshot = _load_snapshot(generation)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.kitchen-snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((SNAPSHOT_FORMAT_VERSION, generation,
+                         DISPLAY_SETTINGS), f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, pickle.PicklingError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    log.info("Wrote repository snapshot {0} to {1}".format(generation, path))
+    return snapshot
+
+
+def _is_trusted_file(f, path):
+    """Checks that an open file is owned by the current user and can't be
+    written by others, as unpickling it runs code
+
+    """
+    stat = os.fstat(f.fileno())
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0o022:
+        log.warning("Ignoring snapshot file {0}: it must be owned by the "
+                    "kitchen user and not writable by others".format(path))
+        return False
+    return True
+
+
+def _read_snapshot_file(generation, path=None):
+    """Returns the snapshot stored in the snapshot file if it was written for
+    the given generation and the current display settings, otherwise None.
+    Files not written by the kitchen user are never loaded
+
+    """
+    path = path or SNAPSHOT_FILE
+    try:
+        with open(path, 'rb') as f:
+            if not _is_trusted_file(f, path):
+                return None
+            header = pickle.load(f)
+            if header != (SNAPSHOT_FORMAT_VERSION, generation,
+                          DISPLAY_SETTINGS):
+                return None
+            return pickle.load(f)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError,
+            AttributeError, ImportError) as e:
+        log.debug("Could not read snapshot file {0}: {1}".format(path, e))
+        return None
+
+
+def get_snapshot():
+    """Returns the repository snapshot, reloading it only when the repository
+    generation has changed. A snapshot file written by the repo sync for the
+    current generation is preferred over reading the repository
+
+    """
+    global _snapshot
+    generation = get_repo_generation()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.generation == generation:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.generation != generation:
+            _snapshot = (_read_snapshot_file(generation) or
+                         _load_snapshot(generation))
+        return _snapshot
+
+
+def invalidate_snapshot():
+    """Discards the current snapshot so that the next access reloads it"""
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
+def get_node_store():
+    """Returns the SQLite node store when it is enabled and up to date with
+    the repository, otherwise None
+
+    """
+    if not NODE_STORE_FILE:
+        return None
+    store = _node_stores.get(NODE_STORE_FILE)
+    if store is None:
+        store = _node_stores.setdefault(NODE_STORE_FILE,
+                                        NodeStore(NODE_STORE_FILE))
+    if not store.is_current(get_repo_generation()):
+        return None
+    return store
+
+
+def find_nodes(env='', roles=None, virt_roles='', extended=True):
+    """Returns nodes which fulfill env, roles and virt_roles criteria,
+    querying the node store when available and the snapshot otherwise
+
+    """
+    store = get_node_store()
+    if store is not None:
+        return store.filter_nodes(env, roles, virt_roles, extended=extended)
+    return get_snapshot().filter_nodes(env, roles, virt_roles,
+                                       extended=extended)
+
+
+def iter_nodes_json(env='', roles=None, virt_roles='', extended=True):
+    """Returns an iterator over the JSON of each node which fulfills env,
+    roles and virt_roles criteria, without building the whole node list.
+    Repository errors are raised before iterating
+
+    """
+    store = get_node_store()
+    if store is not None:
+        return store.iter_node_json(env, roles, virt_roles, extended=extended)
+    snapshot = get_snapshot()
+    nodes = snapshot.nodes_extended if extended else snapshot.nodes
+    return (node_json(nodes[i])
+            for i in snapshot.index.filter_ids(env, roles, virt_roles))
+
+
+def find_node(name):
+    """Returns the given node from the node store when available and the
+    snapshot otherwise, or None when it doesn't exist
+
+    """
+    store = get_node_store()
+    if store is not None:
+        return store.get_node(name)
+    return get_snapshot().get_node(name)
@@ -0,0 +1,130 @@
+"""Readers for LittleChef kitchen files
+They return the same data as LittleChef's lib.get_node, lib.get_nodes,
+lib.get_roles, lib._get_role and lib.get_recipes_in_cookbook, but work with
+absolute paths under the given kitchen dir and never change the working
+directory, so they are safe to use from threads
+
+"""
+import os
+import simplejson as json
+
+import littlechef
+from littlechef import lib
+
+APPLIANCES = ['nodes', 'roles', 'cookbooks', 'data_bags']
+
+
+def check_appliances(kitchen_dir):
+    """Returns whether kitchen_dir is a kitchen along with a list of missing
+    directories
+
+    """
+    missing = [dirname for dirname in APPLIANCES
+               if not os.path.isdir(os.path.join(kitchen_dir, dirname))]
+    return not missing, missing
+
+
+def _read_json(path):
+    """Reads and parses a JSON file. Raises ValueError on syntax errors"""
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+
+def get_node(kitchen_dir, name):
+    """Returns a JSON node file as a dictionary"""
+    path = os.path.join(kitchen_dir, 'nodes', name + '.json')
+    if os.path.exists(path):
+        node = _read_json(path)
+    else:
+        node = {'run_list': []}
+    # Add node name so that we can tell to which node it is
+    node['name'] = name
+    return node
+
+
+def get_nodes(kitchen_dir):
+    """Returns all nodes found in the nodes/ directory"""
+    nodes_dir = os.path.join(kitchen_dir, 'nodes')
+    if not os.path.exists(nodes_dir):
+        return []
+    filenames = sorted([
+        f for f in os.listdir(nodes_dir)
+        if f.endswith(".json") and not f.startswith('.')
+        and not os.path.isdir(os.path.join(nodes_dir, f))])
+    # Remove .json from the filenames to get the node names
+    return [get_node(kitchen_dir, ".".join(f.split('.')[:-1]))
+            for f in filenames]
+
+
+def get_roles(kitchen_dir):
+    """Returns all roles found in the roles/ directory"""
+    roles_dir = os.path.join(kitchen_dir, 'roles')
+    roles = []
+    for root, subfolders, files in os.walk(roles_dir):
+        for filename in files:
+            if filename.endswith(".json"):
+                role = _read_json(os.path.join(root, filename))
+                role['fullname'] = os.path.join(
+                    root[len(roles_dir):], filename[:-len('.json')])
+                roles.append(role)
+    return sorted(roles, key=lambda x: x['fullname'])
+
+
+def get_role(kitchen_dir, name):
+    """Returns a JSON role file as a dictionary. Raises IOError when the role
+    doesn't exist
+
+    """
+    role = _read_json(os.path.join(kitchen_dir, 'roles', name + '.json'))
+    role['fullname'] = name
+    return role
+
+
+def get_recipes_in_cookbook(kitchen_dir, name):
+    """Returns a list of dictionaries with the recipes of a cookbook,
+    regenerating its metadata.json when knife is installed. Raises IOError
+    when the cookbook or its metadata.json don't exist
+
+    """
+    cookbook_dirs = [os.path.join(kitchen_dir, path, name)
+                     for path in littlechef.cookbook_paths]
+    existing = [path for path in cookbook_dirs if os.path.exists(path)]
+    if not existing:
+        raise IOError('Unable to find cookbook "{0}"'.format(name))
+    cookbook = None
+    for path in existing:
+        lib._generate_metadata(path, os.path.dirname(path), name)
+        metadata = os.path.join(path, 'metadata.json')
+        # metadata.json in site-cookbooks has preference
+        if os.path.exists(metadata):
+            cookbook = _read_json(metadata)
+            break
+    if cookbook is None:
+        raise IOError('Cookbook "{0}" has no metadata.json'.format(name))
+    recipe_defaults = {
+        'description': '',
+        'version': cookbook.get('version'),
+        'dependencies': cookbook.get('dependencies', {}).keys(),
+        'attributes': cookbook.get('attributes', {})
+    }
+    recipes = {}
+    for recipe, description in cookbook.get('recipes', {}).items():
+        recipes[recipe] = dict(recipe_defaults, name=recipe,
+                               description=description)
+    # Add recipes found in the recipes/ directories but not in the metadata
+    for path in existing:
+        recipes_dir = os.path.join(path, 'recipes')
+        if not os.path.isdir(recipes_dir):
+            continue
+        for basename in os.listdir(recipes_dir):
+            fname, ext = os.path.splitext(basename)
+            if ext != '.rb':
+                continue
+            recipe = name if fname == 'default' else name + '::' + fname
+            if recipe not in recipes:
+                recipes[recipe] = dict(recipe_defaults, name=recipe)
+    # List cookbooks without a default recipe, such as library cookbooks
+    if not recipes:
+        recipes[name] = dict(recipe_defaults, name=name,
+                             description='This cookbook has no default recipe')
+    return recipes.values()
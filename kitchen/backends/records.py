@@ -0,0 +1,113 @@
+"""Compact node records"""
+import hashlib
+import simplejson as json
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+from kitchen.backends.display import NodeDisplay
+
+# Fields displayed by the list and virt views
+HOT_FIELDS = ('name', 'fqdn', 'hostname', 'ipaddress', 'chef_environment',
+              'run_list', 'role', 'roles', 'recipes', 'tags',
+              'virtualization', 'memory', 'cpu', 'kitchen')
+# Hot fields holding ohai trees, of which only the total is kept
+TOTAL_ONLY_FIELDS = ('memory', 'cpu')
+# Fields computed out of the hot fields when the record is created
+DERIVED_FIELDS = ('display', 'digest')
+SLOT_FIELDS = HOT_FIELDS + DERIVED_FIELDS
+
+
+class NodeRecord(object):
+    """Read-only representation of an extended node which keeps its hot
+    fields in slots and the full merged attribute tree as raw JSON, which is
+    only decoded when other attributes are accessed.
+    'memory' and 'cpu' only hold their 'total' value. The complete trees are
+    returned by attributes(). 'display' holds the NodeDisplay values shown
+    by the list and virt views and 'digest' a hash of the raw JSON
+
+    """
+    __slots__ = SLOT_FIELDS + ('raw',)
+
+    def __init__(self, raw, node=None):
+        if node is None:
+            node = json_loads(raw)
+        for field in HOT_FIELDS:
+            if field not in node:
+                continue  # Missing fields are left unset
+            value = node[field]
+            if field in TOTAL_ONLY_FIELDS and isinstance(value, dict):
+                value = {'total': value.get('total')}
+            setattr(self, field, value)
+        self.display = NodeDisplay(self)
+        self.digest = get_digest(raw)
+        self.raw = raw
+
+    def __eq__(self, other):
+        return isinstance(other, NodeRecord) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getitem__(self, key):
+        if key in SLOT_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.attributes()[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def hot_fields(self):
+        """Returns a dict with the hot and derived fields present in the
+        record
+
+        """
+        fields = {}
+        for field in SLOT_FIELDS:
+            try:
+                fields[field] = getattr(self, field)
+            except AttributeError:
+                pass
+        return fields
+
+    def attributes(self):
+        """Decodes and returns the full merged attribute tree"""
+        return json_loads(self.raw)
+
+
+def get_digest(content):
+    """Returns the hash of the given JSON content"""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_node_digest(node):
+    """Returns the content hash of a node or node record"""
+    digest = node.get('digest')
+    if digest is None:
+        digest = get_digest(json.dumps(node, sort_keys=True))
+    return digest
+
+
+def node_json(node):
+    """Returns the JSON representation of a node or node record"""
+    if isinstance(node, NodeRecord):
+        return node.raw
+    return json.dumps(node)
@@ -1,5 +1,7 @@
 """Repo sync module"""
 import os
+import time
+import sqlite3
 from subprocess import Popen, PIPE
 from logbook import Logger, MonitoringFileHandler
 
@@ -10,8 +12,11 @@ sys.path.append(path)
 os.environ['DJANGO_SETTINGS_MODULE'] = 'kitchen.settings'
 
 from kitchen.settings import (REPO, REPO_BASE_PATH, SYNCDATE_FILE, LOG_FILE,
-                              DEBUG)
+                              NODE_STORE_FILE, SHOW_GRAPH_VIEW,
+                              GRAPH_PRERENDER, DEBUG)
 from kitchen.backends import lchef as chef
+from kitchen.backends.sqlstore import write_node_store
+from kitchen.dashboard import graphs
 
 file_log_handler = MonitoringFileHandler(LOG_FILE, bubble=DEBUG)
 file_log_handler.push_application()
@@ -21,6 +26,9 @@ log = Logger("kitchen.backends.sync")
 class SyncRepo():
     """A Task that syncs the git kitchen repository"""
     REPO_ROOT = os.path.join(REPO_BASE_PATH, REPO['NAME'])
+    # Holds the revision the node data bag was last successfully built from
+    BUILT_REVISION_FILE = os.path.join(REPO_BASE_PATH,
+                                       '.kitchen-built-revision')
 
     def run(self):
         """Syncs the git repository"""
@@ -29,10 +37,20 @@ class SyncRepo():
             self._update()
         else:
             self._clone()
-        self._set_repo_sync_date()
+        # The snapshot and node store are written for the new sync date
+        # before it is set, so that web workers switch straight to them
+        sync_date = float(int(time.time()))
+        written = self._write_snapshot(sync_date)
+        self._set_repo_sync_date(sync_date)
+        if written and SHOW_GRAPH_VIEW and GRAPH_PRERENDER:
+            self._prerender_graphs()
 
     def _update(self):
-        """Do a 'git pull'"""
+        """Do a 'git pull' and rebuild the node data bag items affected by
+        the changes since the last successful build. Without a known built
+        revision, the whole data bag is rebuilt
+
+        """
         cmd = ['git', 'pull']
         p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.REPO_ROOT)
         log.info("Updating repo")
@@ -40,8 +58,70 @@ class SyncRepo():
         if p.returncode != 0:
             log.error("git pull returned {0}: {1}".format(
                       p.returncode, stderr))
+            return
+        changed_files = None
+        head = self._get_head()
+        built_revision = self._get_built_revision()
+        if built_revision and head:
+            changed_files = self._get_changed_files(built_revision, head)
+        if changed_files is None:
+            built = chef.build_node_data_bag()
         else:
-            chef.build_node_data_bag()
+            log.info("{0} files changed between {1} and {2}".format(
+                     len(changed_files), built_revision[:7], head[:7]))
+            built = chef.update_node_data_bag(changed_files)
+        if built and head:
+            self._set_built_revision(head)
+
+    def _get_built_revision(self):
+        """Returns the revision the node data bag was last built from, or
+        None when it is unknown
+
+        """
+        try:
+            with open(self.BUILT_REVISION_FILE, 'r') as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def _set_built_revision(self, revision):
+        """Stores the revision the node data bag was successfully built from"""
+        try:
+            tmp_path = self.BUILT_REVISION_FILE + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(revision)
+            os.rename(tmp_path, self.BUILT_REVISION_FILE)
+        except (IOError, OSError) as e:
+            log.error("Could not store the built revision: {0}".format(e))
+
+    def _get_head(self):
+        """Returns the current commit id, or None if it can't be read"""
+        cmd = ['git', 'rev-parse', 'HEAD']
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.REPO_ROOT)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            log.error("git rev-parse returned {0}: {1}".format(
+                      p.returncode, stderr))
+            return None
+        return stdout.strip()
+
+    def _get_changed_files(self, old, new):
+        """Returns the kitchen relative paths changed between two revisions,
+        or None if they can't be determined. Renamed files are listed under
+        their old and new paths
+
+        """
+        if old == new:
+            return []
+        cmd = ['git', 'diff', '--name-only', '--no-renames', '--relative',
+               old, new]
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=chef.KITCHEN_DIR)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            log.error("git diff returned {0}: {1}".format(
+                      p.returncode, stderr))
+            return None
+        return [path for path in stdout.splitlines() if path]
 
     def _clone(self):
         """Clone a git repository"""
@@ -54,13 +134,41 @@ class SyncRepo():
         if p.returncode != 0:
             log.error("{0} returned {1}: {2}".format(
                       " ".join(cmd), p.returncode, stderr))
-        else:
-            chef.build_node_data_bag()
+        elif chef.build_node_data_bag():
+            head = self._get_head()
+            if head:
+                self._set_built_revision(head)
+
+    def _write_snapshot(self, sync_date):
+        """Writes the repository snapshot loaded by the web workers, and the
+        node store when it is enabled, for the given sync date. Returns
+        whether the snapshot was written
+
+        """
+        try:
+            snapshot = chef.write_snapshot_file(sync_date=sync_date)
+        except (chef.RepoError, IOError, OSError) as e:
+            log.error("Could not write repository snapshot: {0}".format(e))
+            return False
+        if NODE_STORE_FILE:
+            try:
+                write_node_store(NODE_STORE_FILE, snapshot)
+            except (sqlite3.Error, IOError, OSError) as e:
+                log.error("Could not write node store: {0}".format(e))
+        return True
+
+    def _prerender_graphs(self):
+        """Renders the default environment graphs into the graph cache"""
+        log.info("Rendering environment graphs")
+        try:
+            graphs.prerender_graphs()
+        except (chef.RepoError, OSError) as e:
+            log.error("Could not render environment graphs: {0}".format(e))
 
-    def _set_repo_sync_date(self):
+    def _set_repo_sync_date(self, sync_date):
         """Sets the modified date of a file, which will be the sync date"""
         with file(SYNCDATE_FILE, 'a'):
-            os.utime(SYNCDATE_FILE, None)
+            os.utime(SYNCDATE_FILE, (sync_date, sync_date))
 
 
 if __name__ == "__main__":
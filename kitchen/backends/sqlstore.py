@@ -0,0 +1,188 @@
+"""Optional SQLite node store
+Holds the nodes of a repository snapshot with indexed columns for the
+attributes nodes are queried by, so that node queries can be answered
+without loading all nodes in memory
+
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+import simplejson as json
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+from logbook import Logger
+
+from kitchen.backends.records import node_json
+
+log = Logger(__name__)
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    fqdn TEXT,
+    environment TEXT,
+    virt_role TEXT,
+    host TEXT,
+    node BLOB,
+    node_extended BLOB
+);
+CREATE INDEX nodes_fqdn ON nodes (fqdn);
+CREATE INDEX nodes_environment ON nodes (environment);
+CREATE INDEX nodes_virt_role ON nodes (virt_role);
+CREATE INDEX nodes_host ON nodes (host);
+CREATE TABLE node_roles (node_id INTEGER, role_prefix TEXT);
+CREATE INDEX node_roles_prefix ON node_roles (role_prefix, node_id);
+CREATE TABLE node_tags (node_id INTEGER, tag TEXT);
+CREATE INDEX node_tags_tag ON node_tags (tag, node_id);
+"""
+
+
+def _dump_generation(generation):
+    """Serializes a repository generation for storing and comparing it"""
+    return json.dumps(list(generation))
+
+
+def write_node_store(path, snapshot):
+    """Writes the nodes of the given snapshot to a new SQLite file, which
+    atomically replaces the one at path
+
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.kitchen-nodes')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.executescript(SCHEMA)
+            conn.execute("INSERT INTO meta VALUES ('generation', ?)",
+                         (_dump_generation(snapshot.generation),))
+            nodes = []
+            roles = []
+            tags = []
+            for i, node in enumerate(snapshot.nodes_extended):
+                nodes.append((
+                    i, node['name'], node.get('fqdn'),
+                    node.get('chef_environment', 'none'),
+                    node.get('virtualization', {}).get('role'),
+                    snapshot.topology.host_of.get(i),
+                    buffer(json.dumps(snapshot.nodes[i])),
+                    buffer(node_json(node))))
+                for prefix in set(role.split("_")[0]
+                                  for role in node.get('roles', [])):
+                    roles.append((i, prefix))
+                for tag in set(node.get('tags') or []):
+                    tags.append((i, tag))
+            conn.executemany(
+                "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", nodes)
+            conn.executemany("INSERT INTO node_roles VALUES (?, ?)", roles)
+            conn.executemany("INSERT INTO node_tags VALUES (?, ?)", tags)
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp_path, path)
+    except (sqlite3.Error, IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    log.info("Wrote {0} nodes to the node store {1}".format(
+             len(snapshot.nodes), path))
+
+
+class NodeStore(object):
+    """Queries nodes from an SQLite node store file. Each thread uses its own
+    connection, which is reopened when the file is replaced
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """Returns a connection to the current store file"""
+        stat = os.stat(self.path)
+        file_id = (stat.st_ino, stat.st_mtime)
+        if getattr(self._local, 'file_id', None) != file_id:
+            if getattr(self._local, 'conn', None) is not None:
+                self._local.conn.close()
+            self._local.conn = sqlite3.connect(self.path)
+            self._local.file_id = file_id
+        return self._local.conn
+
+    def get_generation(self):
+        """Returns the serialized generation the store was written for, or
+        None when the store can't be read
+
+        """
+        try:
+            row = self._connection().execute(
+                "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        except (sqlite3.Error, OSError) as e:
+            log.debug("Could not read node store {0}: {1}".format(
+                      self.path, e))
+            return None
+        return row[0] if row else None
+
+    def is_current(self, generation):
+        """Checks whether the store was written for the given generation"""
+        return self.get_generation() == _dump_generation(generation)
+
+    def iter_node_json(self, env='', roles=None, virt_roles='', tags=None,
+                       extended=True):
+        """Yields the JSON of the extended or plain nodes which fulfill env,
+        roles, virt_roles and tags criteria, in repository order
+
+        """
+        where = []
+        args = []
+        if env:
+            where.append("environment = ?")
+            args.append(env)
+        if roles:
+            where.append("id IN (SELECT node_id FROM node_roles WHERE "
+                         "role_prefix IN ({0}))".format(
+                             ", ".join("?" * len(roles))))
+            args.extend(roles)
+        if virt_roles:
+            virt_roles = virt_roles.split(',')
+            condition = "virt_role IN ({0})".format(
+                ", ".join("?" * len(virt_roles)))
+            if 'guest' in virt_roles:
+                # Nodes without a virtualization role are considered guests
+                condition += " OR virt_role IS NULL OR virt_role = ''"
+            where.append("(" + condition + ")")
+            args.extend(virt_roles)
+        if tags:
+            where.append("id IN (SELECT node_id FROM node_tags WHERE "
+                         "tag IN ({0}))".format(", ".join("?" * len(tags))))
+            args.extend(tags)
+        query = "SELECT {0} FROM nodes".format(
+            "node_extended" if extended else "node")
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id"
+        for row in self._connection().execute(query, args):
+            yield str(row[0])
+
+    def filter_nodes(self, env='', roles=None, virt_roles='', tags=None,
+                     extended=True):
+        """Returns the extended or plain nodes which fulfill env, roles,
+        virt_roles and tags criteria, in repository order
+
+        """
+        return [json_loads(node) for node in self.iter_node_json(
+            env, roles, virt_roles, tags, extended)]
+
+    def get_node(self, name, extended=False):
+        """Returns the given node, or None when it doesn't exist"""
+        row = self._connection().execute(
+            "SELECT {0} FROM nodes WHERE name = ?".format(
+                "node_extended" if extended else "node"), (name,)).fetchone()
+        if row is None:
+            return None
+        return json_loads(str(row[0]))
@@ -1,10 +1,22 @@
 """Tests for the kitchen.backends app"""
+import os
+import shutil
+import subprocess
+import tempfile
+
 import simplejson as json
 from django.test import TestCase
+from littlechef import lib
 from mock import patch
 
 from kitchen.backends import lchef as chef
 from kitchen.backends import plugins
+from kitchen.backends.repo_sync import SyncRepo
+from kitchen.backends.index import (NodeIndex, HostTopology,
+                                    HOST_DERIVED_FIELDS, GUEST_DERIVED_FIELDS)
+from kitchen.backends.sqlstore import NodeStore, write_node_store
+from kitchen.backends.records import NodeRecord
+from kitchen.backends.display import TagMatcher
 from kitchen.backends.plugins import loader
 
 chef.build_node_data_bag()
@@ -37,7 +49,20 @@ class TestRepo(TestCase):
     def test_missing_node_data_json_error(self):
         """Should raise RepoError when there is a JSON error"""
         nodes = chef._load_data("nodes")  # Load before mocking
-        with patch.object(json, 'loads') as mock_method:
+        with patch('kitchen.backends.lchef.json_loads') as mock_method:
+            mock_method.side_effect = json.decoder.JSONDecodeError(
+                "JSON syntax error", "", 10)
+            self.assertRaises(chef.RepoError, chef._load_extended_node_data,
+                              nodes)
+
+    @patch('kitchen.backends.lchef.BULK_LOAD_MIN_ITEMS', 0)
+    def test_missing_node_data_json_error_parallel(self):
+        """Should raise RepoError when there is a JSON error while reading
+        items in parallel
+
+        """
+        nodes = chef._load_data("nodes")
+        with patch('kitchen.backends.lchef.json_loads') as mock_method:
             mock_method.side_effect = json.decoder.JSONDecodeError(
                 "JSON syntax error", "", 10)
             self.assertRaises(chef.RepoError, chef._load_extended_node_data,
@@ -59,11 +84,35 @@ class TestData(TestCase):
         self.assertTrue(data[1]['name'].startswith('testnode'))
 
     def test_data_loader_json_error(self):
-        """Should raise RepoError when LittleChef raises SystemExit"""
-        with patch('kitchen.backends.lchef.lib.get_nodes') as mock_method:
-            mock_method.side_effect = SystemExit()
+        """Should raise RepoError when there is a JSON syntax error"""
+        with patch('kitchen.backends.lchef.reader.get_nodes') as mock_method:
+            mock_method.side_effect = json.decoder.JSONDecodeError(
+                "JSON syntax error", "", 10)
             self.assertRaises(chef.RepoError, chef._data_loader, 'nodes')
 
+    def test_data_loader_same_as_littlechef(self):
+        """Should return the same data LittleChef returns"""
+        current_dir = os.getcwd()
+        os.chdir(chef.KITCHEN_DIR)
+        try:
+            expected_nodes = lib.get_nodes()
+            expected_node = lib.get_node('testnode2')
+            expected_roles = lib.get_roles()
+        finally:
+            os.chdir(current_dir)
+        self.assertEqual(chef._data_loader('nodes'), expected_nodes)
+        self.assertEqual(chef._data_loader('node', 'testnode2'),
+                         expected_node)
+        self.assertEqual(chef._data_loader('roles'), expected_roles)
+
+    def test_snapshot_does_not_change_dir(self):
+        """Should not change the working directory when loading data"""
+        chef.invalidate_snapshot()
+        with patch('os.chdir') as mock_method:
+            chef.get_snapshot()
+            chef.get_node('testnode2')
+            self.assertFalse(mock_method.called)
+
     def test_load_data_nodes(self):
         """Should return nodes when the given argument is 'nodes'"""
         data = chef._load_data('nodes')
@@ -86,6 +135,16 @@ class TestData(TestCase):
         self.assertEqual(len(data), TOTAL_NODES)
         self.assertTrue(data[1]['name'].startswith('testnode'))
 
+    def test_load_extended_node_data_parallel(self):
+        """Should return the same data when items are read in parallel"""
+        nodes = chef.get_nodes()
+        expected = chef._load_extended_node_data(nodes)
+        with patch('kitchen.backends.lchef.BULK_LOAD_MIN_ITEMS', 0):
+            data = chef._load_extended_node_data(nodes)
+        self.assertEqual(data, expected)
+        self.assertEqual([node['name'] for node in data],
+                         [node['name'] for node in nodes])
+
     def test_get_environments(self):
         """Should return a list of all chef_environment values found"""
         data = chef.get_environments(chef.get_nodes_extended())
@@ -197,6 +256,552 @@ class TestData(TestCase):
         self.assertEqual(len(data[0]['virtualization']['guests']), 3)
 
 
+class TestDataBagUpdate(TestCase):
+
+    def tearDown(self):
+        chef.build_node_data_bag()
+
+    def _item_path(self, name):
+        return os.path.join(chef.DATA_BAG_PATH, name + ".json")
+
+    def _remove_items(self, names):
+        items = {}
+        for name in names:
+            with open(self._item_path(name), 'r') as f:
+                items[name] = json.loads(f.read())
+            os.remove(self._item_path(name))
+        return items
+
+    def test_classify_changed_files(self):
+        """Should group changed files by nodes, roles, envs and cookbooks"""
+        changed = chef._classify_changed_files([
+            'nodes/testnode1.json', 'roles/dbserver.json',
+            'environments/staging.json', 'cookbooks/mysql/recipes/server.rb',
+            'site-cookbooks/apache2/metadata.rb', 'README.md',
+            'nodes/README.md'])
+        self.assertEqual(changed, {
+            'nodes': set(['testnode1']), 'roles': set(['dbserver']),
+            'environments': set(['staging']),
+            'cookbooks': set(['mysql', 'apache2'])})
+
+    def test_update_changed_node(self):
+        """Should rebuild the data bag item of a changed node"""
+        items = self._remove_items(['testnode2'])
+        chef.update_node_data_bag(['nodes/testnode2.json'])
+        with open(self._item_path('testnode2'), 'r') as f:
+            self.assertEqual(json.loads(f.read()), items['testnode2'])
+
+    def test_update_changed_role(self):
+        """Should rebuild the data bag items of nodes with a changed role"""
+        items = self._remove_items(
+            ['testnode3_mydomain_com', 'testnode5', 'testnode2'])
+        chef.update_node_data_bag(['roles/dbserver.json'])
+        for name in ['testnode3_mydomain_com', 'testnode5']:
+            with open(self._item_path(name), 'r') as f:
+                self.assertEqual(json.loads(f.read()), items[name])
+        self.assertFalse(os.path.exists(self._item_path('testnode2')))
+
+    def test_update_changed_cookbook(self):
+        """Should rebuild the data bag items of nodes using a changed
+        cookbook
+
+        """
+        self._remove_items(['testnode1', 'testnode2'])
+        chef.update_node_data_bag(['cookbooks/haproxy/metadata.json'])
+        self.assertTrue(os.path.exists(self._item_path('testnode1')))
+        self.assertFalse(os.path.exists(self._item_path('testnode2')))
+
+    def test_update_same_as_build(self):
+        """Should rebuild the same items as a full build"""
+        items = self._remove_items(['testnode1', 'testnode3_mydomain_com'])
+        chef.update_node_data_bag(['cookbooks/haproxy/metadata.json',
+                                   'roles/dbserver.json'])
+        for name in items:
+            with open(self._item_path(name), 'r') as f:
+                self.assertEqual(json.loads(f.read()), items[name])
+
+    def test_update_does_not_change_dir(self):
+        """Should not change the working directory when rebuilding items"""
+        with patch('os.chdir') as mock_method:
+            self.assertTrue(chef.update_node_data_bag(
+                ['nodes/testnode2.json', 'roles/dbserver.json',
+                 'cookbooks/haproxy/metadata.json']))
+            self.assertFalse(mock_method.called)
+
+    def test_update_unrelated_changes(self):
+        """Should not rebuild anything when no relevant files changed"""
+        self._remove_items(['testnode2'])
+        chef.update_node_data_bag(['README.md', 'data_bags/users/foo.json'])
+        self.assertFalse(os.path.exists(self._item_path('testnode2')))
+
+    def test_update_deleted_node(self):
+        """Should remove the data bag item of a deleted node"""
+        path = self._item_path('deleted_node')
+        with open(path, 'w') as f:
+            f.write('{}')
+        chef.update_node_data_bag(['nodes/other_node.json'])
+        self.assertTrue(os.path.exists(path))
+        chef.update_node_data_bag(['nodes/deleted.node.json'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_update_failed(self):
+        """Should report whether the data bag items were rebuilt"""
+        self.assertTrue(chef.update_node_data_bag(['nodes/testnode2.json']))
+        with patch('kitchen.backends.lchef.reader.get_roles',
+                   side_effect=ValueError("Error")):
+            self.assertFalse(
+                chef.update_node_data_bag(['nodes/testnode2.json']))
+
+
+class TestRepoSync(TestCase):
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self._git('init', '-q')
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def _git(self, *args):
+        """Runs a git command in the test repository"""
+        cmd = ['git', '-c', 'user.name=kitchen',
+               '-c', 'user.email=kitchen@localhost'] + list(args)
+        return subprocess.check_output(cmd, cwd=self.repo).strip()
+
+    def _commit(self):
+        """Commits every change and returns the new revision"""
+        self._git('add', '-A')
+        self._git('commit', '-q', '-m', 'change')
+        return self._git('rev-parse', 'HEAD')
+
+    def test_changed_files_renamed_node(self):
+        """Should list the old path of a renamed node, so that its data bag
+        item is deleted
+
+        """
+        os.mkdir(os.path.join(self.repo, 'nodes'))
+        with open(os.path.join(self.repo, 'nodes', 'old.json'), 'w') as f:
+            f.write('{"run_list": ["role[dbserver]"]}')
+        old = self._commit()
+        self._git('mv', 'nodes/old.json', 'nodes/new.json')
+        new = self._commit()
+        with patch('kitchen.backends.lchef.KITCHEN_DIR', self.repo):
+            changed_files = SyncRepo()._get_changed_files(old, new)
+        self.assertEqual(sorted(changed_files),
+                         ['nodes/new.json', 'nodes/old.json'])
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        chef.invalidate_snapshot()
+
+    def test_get_snapshot(self):
+        """Should load nodes, roles and environments into a snapshot"""
+        snapshot = chef.get_snapshot()
+        self.assertEqual(len(snapshot.nodes), TOTAL_NODES)
+        self.assertEqual(len(snapshot.nodes_extended), TOTAL_NODES)
+        self.assertEqual(len(snapshot.roles), 4)
+        self.assertEqual(snapshot.role_groups,
+                         ['dbserver', 'loadbalancer', 'webserver', 'worker'])
+        self.assertEqual(len(snapshot.environments), 3)
+        self.assertEqual(snapshot.get_node('testnode6'),
+                         {'name': 'testnode6', 'run_list': ['role[webserver]']})
+        self.assertEqual(snapshot.get_node('node_does_not_exist'), None)
+
+    def test_get_snapshot_cached(self):
+        """Should return the same snapshot while the generation is unchanged"""
+        snapshot = chef.get_snapshot()
+        with patch('kitchen.backends.lchef._load_snapshot') as mock_method:
+            self.assertTrue(chef.get_snapshot() is snapshot)
+            self.assertFalse(mock_method.called)
+
+    def test_get_snapshot_new_generation(self):
+        """Should reload the snapshot when the repo generation changes"""
+        snapshot = chef.get_snapshot()
+        with patch('kitchen.backends.lchef.get_repo_generation',
+                   return_value=('kitchen', 'newhead', 1)):
+            new_snapshot = chef.get_snapshot()
+        self.assertFalse(new_snapshot is snapshot)
+        self.assertEqual(new_snapshot.generation, ('kitchen', 'newhead', 1))
+
+    def test_snapshot_get_cached(self):
+        """Should build values derived from a snapshot only once"""
+        snapshot = chef.get_snapshot()
+        calls = []
+
+        def build():
+            calls.append(1)
+            return len(calls)
+        self.assertEqual(snapshot.get_cached('key', build), 1)
+        self.assertEqual(snapshot.get_cached('key', build), 1)
+        self.assertEqual(snapshot.get_cached('other', build), 2)
+
+    @patch('kitchen.backends.lchef.KITCHEN_DIR', '/badrepopath/')
+    def test_get_snapshot_bad_repo(self):
+        """Should raise RepoError instead of serving a cached snapshot when
+        the repo is not found
+
+        """
+        self.assertRaises(chef.RepoError, chef.get_snapshot)
+
+    def test_snapshot_file(self):
+        """Should load the snapshot from the snapshot file written for the
+        current generation instead of reading the repo
+
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with patch('kitchen.backends.lchef.SNAPSHOT_FILE', path):
+                written = chef.write_snapshot_file()
+                chef.invalidate_snapshot()
+                with patch('kitchen.backends.lchef._load_snapshot') as mock:
+                    snapshot = chef.get_snapshot()
+                    self.assertFalse(mock.called)
+        finally:
+            os.remove(path)
+        self.assertEqual(snapshot.generation, written.generation)
+        self.assertEqual(snapshot.nodes_extended, written.nodes_extended)
+        self.assertEqual(snapshot.role_groups, written.role_groups)
+        self.assertEqual(snapshot.filter_nodes('staging'),
+                         written.filter_nodes('staging'))
+        self.assertEqual(len(snapshot.topology.hosts), 3)
+
+    def test_snapshot_file_sync_date(self):
+        """Should load a snapshot file written for the sync date the repo
+        gets afterwards
+
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        fd, syncdate_file = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with patch('kitchen.backends.lchef.SNAPSHOT_FILE', path):
+                with patch('kitchen.backends.lchef.SYNCDATE_FILE',
+                           syncdate_file):
+                    written = chef.write_snapshot_file(
+                        sync_date=1000000000.0)
+                    os.utime(syncdate_file, (1000000000.0, 1000000000.0))
+                    chef.invalidate_snapshot()
+                    with patch('kitchen.backends.lchef._load_snapshot') as m:
+                        snapshot = chef.get_snapshot()
+                        self.assertFalse(m.called)
+        finally:
+            os.remove(path)
+            os.remove(syncdate_file)
+            chef.invalidate_snapshot()
+        self.assertEqual(snapshot.generation[2], 1000000000.0)
+        self.assertEqual(snapshot.generation, written.generation)
+
+    def test_snapshot_file_other_generation(self):
+        """Should ignore a snapshot file written for another generation"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with patch('kitchen.backends.lchef.SNAPSHOT_FILE', path):
+                with patch('kitchen.backends.lchef.get_repo_generation',
+                           return_value=('kitchen', 'oldhead', 1)):
+                    chef.write_snapshot_file()
+                self.assertEqual(
+                    chef._read_snapshot_file(chef.get_repo_generation()),
+                    None)
+        finally:
+            os.remove(path)
+
+    def test_snapshot_file_other_display_settings(self):
+        """Should ignore a snapshot file written with other display settings
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with patch('kitchen.backends.lchef.SNAPSHOT_FILE', path):
+                chef.write_snapshot_file()
+                with patch('kitchen.backends.lchef.DISPLAY_SETTINGS',
+                           ('', [])):
+                    self.assertEqual(chef._read_snapshot_file(
+                        chef.get_repo_generation()), None)
+        finally:
+            os.remove(path)
+
+    def test_snapshot_file_untrusted(self):
+        """Should not load a snapshot file writable by other users"""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with patch('kitchen.backends.lchef.SNAPSHOT_FILE', path):
+                chef.write_snapshot_file()
+                os.chmod(path, 0o666)
+                with patch('kitchen.backends.lchef.pickle.load') as mock:
+                    self.assertEqual(chef._read_snapshot_file(
+                        chef.get_repo_generation()), None)
+                    self.assertFalse(mock.called)
+        finally:
+            os.remove(path)
+
+    def test_snapshot_file_missing(self):
+        """Should read the repo when there is no snapshot file"""
+        with patch('kitchen.backends.lchef.SNAPSHOT_FILE', '/badpath/snap'):
+            snapshot = chef.get_snapshot()
+        self.assertEqual(len(snapshot.nodes), TOTAL_NODES)
+
+    def test_repo_generation(self):
+        """Should include the git HEAD in the repo generation"""
+        generation = chef.get_repo_generation()
+        self.assertEqual(generation[0], chef.KITCHEN_DIR)
+        self.assertEqual(len(generation[1]), 40)
+
+
+class TestNodeIndex(TestCase):
+    nodes = chef.get_nodes_extended()
+
+    def test_filter_same_as_filter_nodes(self):
+        """Should return the same nodes as filter_nodes for any criteria"""
+        index = NodeIndex(self.nodes)
+        for env in ['', 'production', 'staging', 'none', 'non_existing_env']:
+            for roles in [None, ['dbserver'], ['webserver', 'loadbalancer'],
+                          ['non_existing_role']]:
+                for virt_roles in ['', 'guest', 'host', 'host,guest']:
+                    expected = chef.filter_nodes(self.nodes, env, roles,
+                                                 virt_roles)
+                    self.assertEqual(
+                        index.filter(env, roles, virt_roles), expected,
+                        "{0} {1} {2}".format(env, roles, virt_roles))
+
+    def test_filter_guests_without_virt_role(self):
+        """Should consider nodes without virtualization role as guests"""
+        nodes = [{'name': 'a', 'roles': []},
+                 {'name': 'b', 'roles': [], 'virtualization': {}},
+                 {'name': 'c', 'roles': [],
+                  'virtualization': {'role': 'host'}}]
+        index = NodeIndex(nodes)
+        self.assertEqual(index.filter(virt_roles='guest'), nodes[:2])
+        self.assertEqual(index.filter(virt_roles='host'), nodes[2:])
+
+    def test_filter_tags(self):
+        """Should filter nodes by tag"""
+        index = NodeIndex(self.nodes)
+        data = index.filter(tags=['WIP'])
+        self.assertTrue(len(data) > 0)
+        for node in data:
+            self.assertTrue('WIP' in node['tags'])
+
+    def test_snapshot_filter_nodes(self):
+        """Should filter plain and extended snapshot nodes"""
+        snapshot = chef.get_snapshot()
+        data = snapshot.filter_nodes('staging', extended=False)
+        self.assertEqual(data, [snapshot.get_node('testnode4')])
+        data = snapshot.filter_nodes('staging')
+        self.assertEqual(data[0]['role'], ['webserver'])
+
+
+class TestHostTopology(TestCase):
+
+    def test_group_does_not_modify_nodes(self):
+        """Should not modify the given nodes when grouping them"""
+        nodes = chef.get_nodes_extended()
+        expected = json.dumps(nodes)
+        data = chef.group_nodes_by_host(nodes)
+        self.assertEqual(json.dumps(nodes), expected)
+        vms = data[2]['virtualization']['guests']
+        self.assertEqual(vms[0]['fqdn'], 'testnode1')
+        self.assertEqual(vms[0]['role'], ['loadbalancer'])
+
+    def test_group_same_as_linear_scan(self):
+        """Should return the hosts a scan over hosts and guests returns"""
+        nodes = chef.get_nodes_extended()
+        topology = HostTopology(nodes, NodeIndex(nodes))
+        hosts = chef.filter_nodes(nodes, virt_roles='host')
+        guests = chef.filter_nodes(nodes, virt_roles='guest')
+        for env in ['', 'production', 'staging']:
+            for roles in [None, ['dbserver'], ['loadbalancer'], ['worker']]:
+                expected = []
+                for host in hosts:
+                    members = [host] + [
+                        guest for guest in guests
+                        for vm in host['virtualization'].get('guests', [])
+                        if guest['fqdn'] == vm['fqdn']]
+                    if chef.filter_nodes(members, env, roles):
+                        expected.append(host['name'])
+                self.assertEqual(
+                    [host['name'] for host in topology.group(roles, env)],
+                    expected, "{0} {1}".format(env, roles))
+
+    def test_expand_records(self):
+        """Should expand hosts built out of node records into the hosts
+        built out of the full nodes, keeping their derived values
+
+        """
+        records = chef.get_snapshot().nodes_extended
+        nodes = chef.expand_nodes(records)
+        topology = HostTopology(records, NodeIndex(records))
+        hosts = topology.expand(topology.hosts)
+        expected = HostTopology(nodes, NodeIndex(nodes)).hosts
+
+        def strip(host):
+            host = dict(host, virtualization=dict(host['virtualization']))
+            guests = host['virtualization'].get('guests', [])
+            host['virtualization']['guests'] = [
+                dict((key, value) for key, value in vm.iteritems()
+                     if key not in GUEST_DERIVED_FIELDS) for vm in guests]
+            for field in HOST_DERIVED_FIELDS:
+                host.pop(field, None)
+            return host
+        self.assertEqual([strip(host) for host in hosts],
+                         [strip(host) for host in expected])
+        self.assertTrue('domain' in hosts[2])
+        self.assertFalse('domain' in topology.hosts[2])
+        guest = hosts[2]['virtualization']['guests'][0]
+        self.assertEqual(guest['display'].memory,
+                         topology.hosts[2]['virtualization']['guests'][0][
+                             'display'].memory)
+        self.assertEqual(hosts[2]['block_digest'],
+                         topology.hosts[2]['block_digest'])
+
+
+    def test_host_digest(self):
+        """Should give hosts a new digest only when they or their guests
+        change
+
+        """
+        nodes = chef.get_nodes_extended()
+        digests = [host['block_digest']
+                   for host in HostTopology(nodes, NodeIndex(nodes)).hosts]
+        self.assertEqual(len(set(digests)), 3)
+        for node in nodes:
+            if node['name'] == 'testnode1':  # A guest of testnode9
+                node['tags'] = ['changed']
+        changed = [host['block_digest']
+                   for host in HostTopology(nodes, NodeIndex(nodes)).hosts]
+        self.assertEqual(changed[:2], digests[:2])
+        self.assertNotEqual(changed[2], digests[2])
+
+
+class TestNodeStore(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.snapshot = chef.get_snapshot()
+        write_node_store(self.path, self.snapshot)
+        self.store = NodeStore(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_filter_nodes(self):
+        """Should return the same nodes as the snapshot for any criteria"""
+        for env in ['', 'production', 'staging', 'none']:
+            for roles in [None, ['dbserver'], ['webserver', 'loadbalancer']]:
+                for virt_roles in ['', 'guest', 'host', 'host,guest']:
+                    for extended in [True, False]:
+                        expected = chef.expand_nodes(
+                            self.snapshot.filter_nodes(env, roles, virt_roles,
+                                                       extended=extended))
+                        self.assertEqual(
+                            self.store.filter_nodes(env, roles, virt_roles,
+                                                    extended=extended),
+                            expected,
+                            "{0} {1} {2}".format(env, roles, virt_roles))
+
+    def test_filter_nodes_tags(self):
+        """Should filter nodes by tag"""
+        data = self.store.filter_nodes(tags=['WIP'])
+        self.assertEqual(data, chef.expand_nodes(
+            self.snapshot.index.filter(tags=['WIP'])))
+
+    def test_get_node(self):
+        """Should return a node when it exists and None otherwise"""
+        self.assertEqual(self.store.get_node('testnode6'),
+                         {'name': 'testnode6', 'run_list': ['role[webserver]']})
+        self.assertEqual(self.store.get_node('node_does_not_exist'), None)
+
+    def test_find_nodes(self):
+        """Should answer node queries from the store when it is current"""
+        with patch('kitchen.backends.lchef.NODE_STORE_FILE', self.path):
+            self.assertTrue(chef.get_node_store() is not None)
+            with patch('kitchen.backends.lchef.get_snapshot') as mock_method:
+                data = chef.find_nodes('staging')
+                node = chef.find_node('testnode4')
+                self.assertFalse(mock_method.called)
+        self.assertEqual(data[0]['name'], 'testnode4')
+        self.assertEqual(node['name'], 'testnode4')
+
+    def test_find_nodes_outdated_store(self):
+        """Should not use the store when it belongs to another generation"""
+        with patch('kitchen.backends.lchef.NODE_STORE_FILE', self.path):
+            with patch('kitchen.backends.lchef.get_repo_generation',
+                       return_value=('kitchen', 'newhead', 1)):
+                self.assertEqual(chef.get_node_store(), None)
+
+
+class TestNodeRecord(TestCase):
+    node = {
+        'name': 'testnode', 'fqdn': 'testnode', 'ipaddress': '1.1.1.1',
+        'run_list': ['role[webserver]'], 'tags': ['WIP'],
+        'memory': {'total': '1024000kB', 'free': '512000kB'},
+        'cpu': {'total': 2, '0': {'flags': ['fpu', 'vme']}},
+        'apache2': {'client_roles': ['loadbalancer']}
+    }
+
+    def test_hot_fields(self):
+        """Should serve hot fields without decoding the attribute tree"""
+        record = NodeRecord(json.dumps(self.node))
+        with patch('kitchen.backends.records.json_loads') as mock_method:
+            self.assertEqual(record['name'], 'testnode')
+            self.assertEqual(record.get('tags'), ['WIP'])
+            self.assertEqual(record['memory'], {'total': '1024000kB'})
+            self.assertEqual(record['cpu'], {'total': 2})
+            self.assertEqual(record.get('kitchen', {}), {})
+            self.assertFalse('kitchen' in record)
+            self.assertFalse(mock_method.called)
+
+    def test_attributes(self):
+        """Should decode the full attribute tree when needed"""
+        record = NodeRecord(json.dumps(self.node))
+        self.assertEqual(record['apache2'], self.node['apache2'])
+        self.assertEqual(record.attributes(), self.node)
+        self.assertRaises(KeyError, record.__getitem__, 'missing')
+
+    def test_display(self):
+        """Should compute the display values when the record is created"""
+        record = NodeRecord(json.dumps(self.node))
+        with patch('kitchen.backends.records.json_loads') as mock_method:
+            display = record['display']
+            self.assertFalse(mock_method.called)
+        self.assertEqual(display.roles, ['webserver'])
+        self.assertEqual(display.recipes, [])
+        self.assertEqual(display.memory, '1 GB')
+        self.assertEqual(display.cpus, 2)
+        self.assertEqual(display.tags, [('WIP', 'btn-warning')])
+
+    def test_display_missing_fields(self):
+        """Should display missing memory and cpus as empty values"""
+        display = NodeRecord(json.dumps({'name': 'testnode'})).display
+        self.assertEqual((display.roles, display.memory, display.cpus,
+                          display.tags), ([], '', '-', []))
+
+    def test_tag_matcher(self):
+        """Should match exact tags first and then the longest prefix"""
+        matcher = TagMatcher({'WIP': 'a', 'Node*': 'b', 'NodeSpecial*': 'c',
+                              'x.y*': 'd'})
+        self.assertEqual(matcher.get_class('WIP'), 'a')
+        self.assertEqual(matcher.get_class('Node1'), 'b')
+        self.assertEqual(matcher.get_class('NodeSpecial3'), 'c')
+        self.assertEqual(matcher.get_class('x.yz'), 'd')
+        self.assertEqual(matcher.get_class('xzyz'), '')
+        self.assertEqual(matcher.get_class('Nod'), '')
+        self.assertEqual(TagMatcher({}).get_class('WIP'), '')
+
+    def test_snapshot_records(self):
+        """Should keep snapshot extended nodes as records"""
+        snapshot = chef.get_snapshot()
+        self.assertTrue(isinstance(snapshot.nodes_extended[0], NodeRecord))
+        self.assertEqual(chef.expand_nodes(snapshot.nodes_extended),
+                         chef.get_nodes_extended())
+
+
 class TestPlugins(TestCase):
 
     def test_import_plugin_not_found(self):
@@ -2,37 +2,178 @@
 # -*- coding: utf-8 -*-
 import json
 
-from django.http import HttpResponse, Http404
-from django.views.decorators.http import require_http_methods
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams HttpResponse iterators
+    StreamingHttpResponse = HttpResponse
+from django.views.decorators.http import require_http_methods, etag
 
 from kitchen.backends import lchef as chef
+from kitchen.dashboard import graphs, rows
+from kitchen.dashboard.conditional import repo_condition
+from kitchen.dashboard.fragments import FragmentCache
+from kitchen.settings import REPO, GRAPH_JSON_CACHE_MAX_SIZE
+
+# Node details requested for their current digest never change
+DETAILS_MAX_AGE = 365*24*60*60
+
+# Serialized graph data, per repository generation and request parameters
+graph_cache = FragmentCache(GRAPH_JSON_CACHE_MAX_SIZE)
 
 
 @require_http_methods(["GET"])
+@repo_condition()
 def get_roles(request):
     """Returns all nodes in the repo"""
-    data = chef.get_roles()
+    data = chef.get_snapshot().roles
     return HttpResponse(json.dumps(data), content_type="application/json")
 
 
+def _ndjson_lines(nodes_json):
+    """Yields one line per node JSON"""
+    for node in nodes_json:
+        # JSON strings can't contain raw newlines, only whitespace can
+        yield node.replace('\r', ' ').replace('\n', ' ') + '\n'
+
+
 @require_http_methods(["GET"])
+@repo_condition()
 def get_nodes(request):
     """Returns node files. If 'extended' is given, the extended version is
-    returned
+    returned. With 'format=ndjson' nodes are streamed one per line
 
     """
-    if request.GET.get('extended'):
-        data = chef.get_nodes_extended()
-    else:
-        data = chef.get_nodes()
-    data = chef.filter_nodes(data, request.GET.get('env'))
+    if request.GET.get('format') == 'ndjson':
+        nodes_json = chef.iter_nodes_json(
+            request.GET.get('env'), extended=bool(request.GET.get('extended')))
+        return StreamingHttpResponse(_ndjson_lines(nodes_json),
+                                     content_type="application/x-ndjson")
+    extended = bool(request.GET.get('extended'))
+    data = chef.find_nodes(request.GET.get('env'), extended=extended)
+    if extended:
+        data = chef.expand_nodes(data)
     return HttpResponse(json.dumps(data), content_type="application/json")
 
 
 @require_http_methods(["GET"])
+@repo_condition()
 def get_node(request, name):
     """Returns a node"""
-    data = chef.get_node(name)
+    data = chef.find_node(name)
     if not data:
         raise Http404()
     return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def _get_details_etag(request, name):
+    """Returns the digest of the node content"""
+    return chef.get_snapshot().get_node_digest(name)
+
+
+@require_http_methods(["GET"])
+@etag(_get_details_etag)
+def get_node_details(request, name):
+    """Returns a node as the row details of the list and virt views show it.
+    When 'v' is the digest of the current node content, as given along with
+    the rows, the response is cached for a long time
+
+    """
+    snapshot = chef.get_snapshot()
+    data = snapshot.get_node(name)
+    if data is None:
+        raise Http404()
+    response = HttpResponse(json.dumps(data), content_type="application/json")
+    if request.GET.get('v') == snapshot.get_node_digest(name):
+        response['Cache-Control'] = 'public, max-age={0}'.format(
+            DETAILS_MAX_AGE)
+    return response
+
+
+@require_http_methods(["GET"])
+@repo_condition()
+def get_graph(request):
+    """Returns the clusters, nodes, edges and related roles of the node map
+    of an environment, filtered by 'roles'. Host names are left out of node
+    labels when 'show_hostnames' is 0
+
+    """
+    env = request.GET.get('env')
+    if not env:
+        return HttpResponseBadRequest("No environment given")
+    roles = [role for role in request.GET.get('roles', '').split(',')
+             if role]
+    show_hostnames = request.GET.get('show_hostnames') != '0'
+    snapshot = chef.get_snapshot()
+    key = (snapshot.generation, env, tuple(sorted(set(roles))),
+           show_hostnames)
+    data = graph_cache.get(key)
+    if data is None:
+        data = json.dumps(graphs.get_graph_data(snapshot, env, roles,
+                                                show_hostnames))
+        graph_cache.set(key, data)
+    return HttpResponse(data, content_type="application/json")
+
+
+@require_http_methods(["GET"])
+@repo_condition()
+def get_dependencies(request):
+    """Returns the nodes and roles of an environment that transitively
+    depend on the given 'role' or 'node' with 'direction=downstream' (the
+    default), or that it depends on with 'direction=upstream'
+
+    """
+    env = request.GET.get('env')
+    role = request.GET.get('role')
+    node = request.GET.get('node')
+    direction = request.GET.get('direction', 'downstream')
+    if not env or not (role or node):
+        return HttpResponseBadRequest("An environment and a role or node "
+                                      "are required")
+    if direction not in ['downstream', 'upstream']:
+        return HttpResponseBadRequest("Unknown direction " + direction)
+    index = graphs.get_dependency_index(chef.get_snapshot(), env)
+    data = index.search(role, node, direction)
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+def _get_int(request, name, default=0):
+    """Returns an integer request parameter"""
+    try:
+        return int(request.GET.get(name, default))
+    except ValueError:
+        return default
+
+
+@require_http_methods(["GET"])
+@repo_condition()
+def get_rows(request):
+    """Returns a page of node list rows for DataTables server side
+    processing. Nodes are filtered by 'env', 'roles' and 'virt' as the list
+    view does, searched by 'sSearch' and sorted by the 'iSortCol_<n>' and
+    'sSortDir_<n>' columns. The digests of the nodes are given to request
+    their details
+
+    """
+    roles = [role for role in request.GET.get('roles', '').split(',')
+             if role]
+    sorting = []
+    for i in range(_get_int(request, 'iSortingCols')):
+        sorting.append((_get_int(request, 'iSortCol_{0}'.format(i)),
+                        request.GET.get('sSortDir_{0}'.format(i)) == 'desc'))
+    total, filtered, cells, digests = rows.get_page(
+        chef.get_snapshot(),
+        request.GET.get('env', REPO['DEFAULT_ENV']), roles,
+        request.GET.get('virt', REPO['DEFAULT_VIRT']),
+        request.GET.get('sSearch', ''), sorting,
+        max(0, _get_int(request, 'iDisplayStart')),
+        _get_int(request, 'iDisplayLength', 100))
+    data = {
+        'sEcho': _get_int(request, 'sEcho'),
+        'iTotalRecords': total,
+        'iTotalDisplayRecords': filtered,
+        'aaData': cells,
+        'digests': digests,
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
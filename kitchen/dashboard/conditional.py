@@ -0,0 +1,73 @@
+"""Conditional GET support. Responses are validated with an ETag built out of
+the repository generation and the request parameters, and with the last sync
+date as Last-Modified, so that unchanged data is answered with a 304 before
+it is loaded. Responses which also depend on other values only use the ETag
+
+"""
+import hashlib
+from functools import wraps
+
+from django.http import HttpResponseNotModified
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
+
+from kitchen.backends.lchef import get_repo_generation
+
+
+def _get_etag(request, generation, extra):
+    """Returns the ETag of a request for the given generation"""
+    key = [generation, request.path, sorted(request.GET.lists()), extra]
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def _is_not_modified(request, etag, last_modified):
+    """Checks the request validators. If-None-Match takes precedence over
+    If-Modified-Since. Parsed ETags are unquoted
+
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return bool(last_modified and if_modified_since and
+                int(last_modified) <= if_modified_since)
+
+
+def repo_condition(get_extra=None):
+    """Returns a decorator for views whose response only depends on the
+    repository data, the request path and parameters, and get_extra(request)
+    when given. Answers GET requests with a 304 when the client's copy is
+    current, and adds ETag and Last-Modified headers to successful responses
+    that don't set 'Cache-Control: no-store'. With get_extra, the response
+    may change without the sync date changing, so it gets no Last-Modified
+    and If-Modified-Since is ignored
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(request, *args, **kwargs)
+            generation = get_repo_generation()
+            extra = None
+            last_modified = generation[2]
+            if get_extra is not None:
+                extra = get_extra(request)
+                last_modified = None
+            etag = _get_etag(request, generation, extra)
+            if _is_not_modified(request, etag, last_modified):
+                response = HttpResponseNotModified()
+                response['ETag'] = quote_etag(etag)
+                return response
+            response = func(request, *args, **kwargs)
+            if (response.status_code == 200 and
+                    'no-store' not in response.get('Cache-Control', '')):
+                if not response.has_header('ETag'):
+                    response['ETag'] = quote_etag(etag)
+                if last_modified and not response.has_header('Last-Modified'):
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+        return inner
+    return decorator
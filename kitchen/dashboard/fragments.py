@@ -0,0 +1,97 @@
+"""Cache of rendered node rows. List and virt pages are joined out of the
+rows rendered for earlier requests, and only the rows of new or changed
+nodes are rendered
+
+"""
+import collections
+import threading
+
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from kitchen.backends import lchef
+from kitchen.backends.display import DISPLAY_SETTINGS
+from kitchen.backends.records import get_node_digest
+from kitchen.settings import ROW_CACHE_MAX_SIZE
+
+
+class FragmentCache(object):
+    """Least recently used store of rendered fragments, bounded by their
+    total size in characters
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._fragments = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get(self, key):
+        """Returns the fragment stored under key, or None"""
+        with self._lock:
+            fragment = self._fragments.pop(key, None)
+            if fragment is not None:
+                self._fragments[key] = fragment  # Now the most recently used
+            return fragment
+
+    def set(self, key, fragment):
+        """Stores a fragment, evicting the least recently used ones when the
+        maximum size is exceeded
+
+        """
+        if len(fragment) > self.max_size:
+            return
+        with self._lock:
+            previous = self._fragments.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._fragments[key] = fragment
+            self.size += len(fragment)
+            while self.size > self.max_size:
+                evicted = self._fragments.popitem(last=False)[1]
+                self.size -= len(evicted)
+
+    def clear(self):
+        """Removes all fragments"""
+        with self._lock:
+            self._fragments.clear()
+            self.size = 0
+
+
+row_cache = FragmentCache(ROW_CACHE_MAX_SIZE)
+
+
+def render_row_list(template_name, nodes, show_links, digest_field='digest',
+                    topology=None):
+    """Returns the given nodes rendered by a row template. A row is rendered,
+    with kitchen plugin data, only when the cache has none for the node
+    content, given by digest_field, and the settings rows depend on.
+    Hosts are given along with the HostTopology that grouped them
+
+    """
+    settings_key = (template_name, show_links, DISPLAY_SETTINGS,
+                    tuple(sorted(lchef.plugins)))
+    keys = [(node.get(digest_field) or get_node_digest(node),) + settings_key
+            for node in nodes]
+    rows = [row_cache.get(key) for key in keys]
+    missing = [i for i, row in enumerate(rows) if row is None]
+    if missing:
+        template = get_template(template_name)
+        expanded = lchef.with_plugin_data([nodes[i] for i in missing],
+                                          topology)
+        for i, node in zip(missing, expanded):
+            rows[i] = template.render(Context({'node': node,
+                                               'show_links': show_links}))
+            row_cache.set(keys[i], rows[i])
+    return rows
+
+
+def render_rows(template_name, nodes, show_links, digest_field='digest',
+                topology=None):
+    """Returns the given nodes rendered by a row template, joined"""
+    return mark_safe(u''.join(render_row_list(
+        template_name, nodes, show_links, digest_field, topology)))
@@ -1,62 +1,39 @@
 """Facility to render node graphs using pydot"""
 import os
+import time
+import collections
+import hashlib
 import subprocess
 import tempfile
 import threading
+from multiprocessing import Pool
 
 import pydot
 from logbook import Logger
 
-from kitchen.settings import STATIC_ROOT, REPO, COLORS
-from kitchen.backends.lchef import get_role_groups
+from kitchen.settings import (STATIC_ROOT, STATIC_URL, REPO, COLORS,
+                              GRAPH_CACHE_DIR, GRAPH_CACHE_MAX_SIZE,
+                              GRAPH_CACHE_MAX_AGE, GRAPH_MAX_RENDERS,
+                              GRAPH_USE_PYDOT, GRAPH_LAYOUTS,
+                              GRAPH_COLLAPSE_THRESHOLD)
+from kitchen.backends.lchef import (get_role_groups, get_snapshot,
+                                    expand_nodes, filter_nodes, RepoError)
 
 log = Logger(__name__)
 
+RENDER_TIMEOUT = 10.0  # Seconds
+# Renders done after a repository sync don't keep anybody waiting
+PRERENDER_TIMEOUT = 60.0  # Seconds
 
-def get_role_relations(env, roles, env_nodes):
+
+def get_role_relations(env, roles, env_nodes, env_links=None):
     """Obtains extra relations with other roles"""
     if not roles:
         # Is a full environment graph
         return []
-
-    # Get all links for the given environment nodes
-    env_links = _build_links(env_nodes)
-
-    # Append related nodes outside the given roles
-    inside_nodes = []
-    related_nodes = []
-    for fqdn in env_links:
-        if env_links[fqdn]['role_prefix'] in roles:
-            if fqdn not in inside_nodes:
-                # Node inside the given roles
-                inside_nodes.append(fqdn)
-            rel_nodes = (env_links[fqdn].get('needs_nodes', []) +
-                         env_links[fqdn].get('client_nodes', []))
-            for rel_node in rel_nodes:
-                if rel_node[0] not in related_nodes:
-                    # Related node outside the given roles
-                    related_nodes.append(rel_node[0])
-
-    extra_roles = []
-    # Check if the role nodes appear as links in other different roles
-    for fqdn in env_links:
-        if (fqdn not in inside_nodes and
-                env_links[fqdn]['role_prefix'] not in roles):
-            rel_nodes = (env_links[fqdn].get('needs_nodes', []) +
-                         env_links[fqdn].get('client_nodes', []))
-            for rel_node in rel_nodes:
-                if (rel_node[0] in inside_nodes and
-                        env_links[fqdn]['role_prefix'] not in extra_roles):
-                    extra_roles.append(env_links[fqdn]['role_prefix'])
-
-    # Check if the roles of the related nodes are links with the given roles
-    for fqdn in related_nodes:
-        link_node = env_links.get(fqdn)
-        if (link_node['role_prefix'] not in roles and
-                link_node['role_prefix'] not in extra_roles):
-            extra_roles.append(link_node['role_prefix'])
-
-    return sorted(extra_roles)
+    if env_links is None:
+        env_links = EnvironmentLinks(env_nodes)
+    return env_links.get_related_roles(roles)
 
 
 def _get_role_prefix(node):
@@ -73,72 +50,430 @@ def _get_role_prefix(node):
     return role_prefix
 
 
+def _get_link_declarations(node):
+    """Returns the (attribute, client_roles, needs_roles) tuples of the node
+    attributes that declare relations to other roles
+
+    """
+    declarations = []
+    for attr in node.keys():
+        client_roles = []
+        try:
+            client_roles = node[attr]['client_roles']
+        except (TypeError, KeyError):
+            pass
+        needs_roles = []
+        try:
+            needs_roles = node[attr]['needs_roles']
+        except (TypeError, KeyError):
+            pass
+        if client_roles or needs_roles:
+            declarations.append((attr, client_roles, needs_roles))
+    return declarations
+
+
+def _build_role_index(nodes):
+    """Returns a dictionary mapping each role to the positions of the nodes
+    that have it
+
+    """
+    role_index = {}
+    for position, node in enumerate(nodes):
+        for role in node['roles']:
+            role_index.setdefault(role, set()).add(position)
+    return role_index
+
+
 def _build_links(nodes):
     """Returns a dictionary of nodes that have links to other nodes
     A node builds its links by looking for other nodes with roles present
     in its 'client_nodes' lists
 
     """
+    role_index = _build_role_index(nodes)
+
+    def resolve(roles):
+        """Returns the positions of the nodes having any of the roles"""
+        positions = set()
+        for role in roles:
+            positions.update(role_index.get(role, ()))
+        return sorted(positions)
+
     linked_nodes = {}
     for node in nodes:
         links = {}
-        for attr in node.keys():
-            client_roles = []
-            try:
-                client_roles = node[attr]['client_roles']
-            except (TypeError, KeyError):
-                pass
-            for client_node in nodes:
-                if set.intersection(
-                        set(client_roles), set(client_node['roles'])):
-                    links.setdefault('client_nodes', [])
-                    links['client_nodes'].append((client_node['name'], attr))
-            needs_roles = []
-            try:
-                needs_roles = node[attr]['needs_roles']
-            except (TypeError, KeyError):
-                pass
-            for needed_node in nodes:
-                if set.intersection(
-                        set(needs_roles), set(needed_node['roles'])):
-                    links.setdefault('needs_nodes', [])
-                    links['needs_nodes'].append((needed_node['name'], attr))
+        for attr, client_roles, needs_roles in _get_link_declarations(node):
+            for position in resolve(client_roles):
+                links.setdefault('client_nodes', [])
+                links['client_nodes'].append((nodes[position]['name'], attr))
+            for position in resolve(needs_roles):
+                links.setdefault('needs_nodes', [])
+                links['needs_nodes'].append((nodes[position]['name'], attr))
         links['role_prefix'] = _get_role_prefix(node)
         linked_nodes[node['name']] = links
     return linked_nodes
 
 
-def generate_node_map(nodes, roles, show_hostnames=True):
-    """Generates a graphviz node map"""
+class EnvironmentLinks(object):
+    """Links between the nodes of an environment. They are built once out of
+    the full attribute trees of the nodes, and can then be queried for any
+    subset of the environment nodes, which may be node records
+
+    """
+    def __init__(self, nodes):
+        self.links = _build_links(nodes)
+        # Maps node names to all their roles, which links are resolved with
+        self.node_roles = dict((node['name'], node.get('roles', []))
+                               for node in nodes)
+
+    def get_links(self, nodes):
+        """Returns the links between the given nodes, the same as
+        _build_links(nodes) does
+
+        """
+        names = set(node['name'] for node in nodes)
+        if not names.issubset(self.links):
+            return _build_links(expand_nodes(nodes))
+        links = {}
+        for node in nodes:
+            node_links = self.links[node['name']]
+            links[node['name']] = {'role_prefix': node_links['role_prefix']}
+            for link_type in ['client_nodes', 'needs_nodes']:
+                related = [link for link in node_links.get(link_type, [])
+                           if link[0] in names]
+                if related:
+                    links[node['name']][link_type] = related
+        return links
+
+    def get_related_roles(self, roles):
+        """Returns the sorted role prefixes outside the given roles that have
+        nodes linked with nodes inside the given roles
+
+        """
+        roles = set(roles)
+        inside_nodes = set(name for name, links in self.links.iteritems()
+                           if links['role_prefix'] in roles)
+        extra_roles = set()
+        for name, links in self.links.iteritems():
+            rel_nodes = set(rel_node[0] for rel_node in
+                            links.get('needs_nodes', []) +
+                            links.get('client_nodes', []))
+            if name in inside_nodes:
+                # Related nodes outside the given roles
+                for rel_node in rel_nodes:
+                    extra_roles.add(self.links[rel_node]['role_prefix'])
+            elif rel_nodes & inside_nodes:
+                # Nodes of other roles linked with the given roles
+                extra_roles.add(links['role_prefix'])
+        return sorted(extra_roles - roles)
+
+
+class DependencyIndex(object):
+    """Adjacency index of the dependencies between the nodes of an
+    environment. A node depends on the nodes it needs ('needs_roles') and on
+    the nodes it is a client of ('client_roles' of the other nodes).
+    Searched roles match any of a node's roles, by full name or prefix
+
+    """
+    def __init__(self, env_links):
+        self.role_prefix = {}
+        self.nodes_by_role = {}
+        # Maps nodes to the nodes they depend on, and reverse
+        self.dependencies = {}
+        self.dependents = {}
+        for name, roles in env_links.node_roles.iteritems():
+            for role in roles:
+                for key in set([role, role.split("_")[0]]):
+                    self.nodes_by_role.setdefault(key, set()).add(name)
+        for name, links in env_links.links.iteritems():
+            self.role_prefix[name] = links['role_prefix']
+            self.dependencies.setdefault(name, set())
+            self.dependents.setdefault(name, set())
+        for name, links in env_links.links.iteritems():
+            for client in links.get('client_nodes', []):
+                self._add(client[0], name)
+            for needed in links.get('needs_nodes', []):
+                self._add(name, needed[0])
+
+    def _add(self, dependent, dependency):
+        """Adds a dependency edge"""
+        self.dependencies[dependent].add(dependency)
+        self.dependents[dependency].add(dependent)
+
+    def _search(self, adjacency, start):
+        """Returns the nodes reachable from the start nodes, excluding them,
+        sorted by distance and name
+
+        """
+        distances = dict((name, 0) for name in start)
+        queue = collections.deque(start)
+        while queue:
+            name = queue.popleft()
+            for other in adjacency[name]:
+                if other not in distances:
+                    distances[other] = distances[name] + 1
+                    queue.append(other)
+        reached = [(distance, node_name) for node_name, distance
+                   in distances.iteritems() if distance]
+        return [{'name': node_name, 'role': self.role_prefix[node_name],
+                 'distance': distance}
+                for distance, node_name in sorted(reached)]
+
+    def search(self, role=None, node=None, direction='downstream'):
+        """Returns the nodes and roles that transitively depend on the given
+        role or node (downstream), or that it depends on (upstream)
+
+        """
+        if node is not None:
+            start = [node] if node in self.role_prefix else []
+        else:
+            start = sorted(self.nodes_by_role.get(role, ()))
+        if direction == 'upstream':
+            nodes = self._search(self.dependencies, start)
+        else:
+            nodes = self._search(self.dependents, start)
+        roles = sorted(set(item['role'] for item in nodes))
+        return {'nodes': nodes, 'roles': roles}
+
+
+def get_env_links(snapshot, env):
+    """Returns the EnvironmentLinks of an environment of the snapshot. Node
+    records are only decoded the first time, when the links are built.
+    Only the environments of the snapshot are cached
+
+    """
+    def build():
+        return EnvironmentLinks(expand_nodes(
+            snapshot.filter_nodes(env, virt_roles='guest')))
+    if not snapshot.has_environment(env):
+        return build()
+    return snapshot.get_cached(('env_links', env), build)
+
+
+def get_dependency_index(snapshot, env):
+    """Returns the dependency index of an environment of the snapshot. Only
+    the environments of the snapshot are cached
+
+    """
+    def build():
+        return DependencyIndex(get_env_links(snapshot, env))
+    if not snapshot.has_environment(env):
+        return build()
+    return snapshot.get_cached(('dependency_index', env), build)
+
+
+def _get_role_colors(roles):
+    """Returns (role group, color) pairs for the graph clusters"""
+    role_colors = []
+    color_index = 0
+    for role in get_role_groups(roles) + ['none']:
+        role_colors.append((role, COLORS[color_index]))
+        color_index += 1
+        if color_index >= len(COLORS):
+            color_index = 0
+    return role_colors
+
+
+def _get_node_label(node, show_hostnames):
+    """Returns the graph label of a node, which is also its graph name"""
+    label = "\n".join([role for role in node['role']
+                       if not role.startswith(REPO['EXCLUDE_ROLE_PREFIX'])])
+    if show_hostnames:
+        label = node['name'] + "\n" + label
+    elif not label:
+        label = "norole"
+    return label
+
+
+def _quote(value):
+    """Returns the value as a DOT quoted string"""
+    return '"' + value.replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n') + '"'
+
+
+def _get_graph_names(nodes, show_hostnames):
+    """Returns a dictionary mapping node names to unique graph node names.
+    Without host names, nodes with the same label are numbered
+
+    """
+    graph_names = {}
+    first_of_label = {}  # Only used when show_hostnames = False
+    for node in nodes:
+        label = _get_node_label(node, show_hostnames)
+        if not show_hostnames:
+            if label in first_of_label:
+                first_node, count = first_of_label[label]
+                if count == 1:
+                    graph_names[first_node] = label + " (1)"
+                first_of_label[label] = first_node, count + 1
+                label += " ({0})".format(count + 1)
+            else:
+                first_of_label[label] = node['name'], 1
+        graph_names[node['name']] = label
+    return graph_names
+
+
+def write_dot_source(nodes, roles, show_hostnames, links):
+    """Writes the DOT source of a node map in a single pass over the nodes,
+    without building pydot objects
+
+    """
+    role_colors = _get_role_colors(roles)
+    cluster_nodes = dict((role, []) for role, color in role_colors)
+    graph_names = _get_graph_names(nodes, show_hostnames)
+    for node in nodes:
+        cluster_nodes[_get_role_prefix(node)].append(node['name'])
+
+    lines = ['digraph G {']
+    for role, color in role_colors:
+        lines.append('subgraph {0} {{'.format(_quote('cluster_' + role)))
+        lines.append('color={0};'.format(_quote(color)))
+        lines.append('fontsize=12;')
+        lines.append('label={0};'.format(_quote(role)))
+        for name in cluster_nodes[role]:
+            lines.append(_quote(graph_names[name]) +
+                         ' [shape=box, fontsize=9, style=filled, '
+                         'fillcolor={0}];'.format(_quote(color)))
+        lines.append('}')
+    for node in nodes:
+        node_links = links[node['name']]
+        name = _quote(graph_names[node['name']])
+        for client in node_links.get('client_nodes', []):
+            lines.append(_quote(graph_names[client[0]]) + ' -> ' + name +
+                         ' [arrowsize=0.6, fontsize=8, label=' +
+                         _quote(client[1]) + '];')
+        for client in node_links.get('needs_nodes', []):
+            lines.append(name + ' -> ' + _quote(graph_names[client[0]]) +
+                         ' [arrowsize=0.6, style=dashed, fontsize=7, label=' +
+                         _quote(client[1]) + '];')
+    lines.append('}')
+    return "\n".join(lines) + "\n"
+
+
+def write_role_graph_source(nodes, roles, links):
+    """Writes the DOT source of a graph with one vertex per role, labelled
+    with its node count. Links between nodes are aggregated into one edge per
+    pair of roles and attribute, labelled with the number of links
+
+    """
+    prefixes = {}
+    counts = {}
+    for node in nodes:
+        prefix = _get_role_prefix(node)
+        prefixes[node['name']] = prefix
+        counts[prefix] = counts.get(prefix, 0) + 1
+    edges = []  # In the order they are first found
+    edge_counts = {}
+    for node in nodes:
+        node_links = links[node['name']]
+        prefix = prefixes[node['name']]
+        node_edges = [(prefixes[client[0]], prefix, client[1], 'client')
+                      for client in node_links.get('client_nodes', [])]
+        node_edges.extend((prefix, prefixes[client[0]], client[1], 'needs')
+                          for client in node_links.get('needs_nodes', []))
+        for edge in node_edges:
+            if edge not in edge_counts:
+                edges.append(edge)
+                edge_counts[edge] = 0
+            edge_counts[edge] += 1
+    lines = ['digraph G {']
+    for role, color in _get_role_colors(roles):
+        if role in counts:
+            label = "{0}\n{1} node{2}".format(
+                role, counts[role], "" if counts[role] == 1 else "s")
+            lines.append(_quote(role) + ' [shape=box, fontsize=9, '
+                         'style=filled, fillcolor={0}, label={1}];'.format(
+                             _quote(color), _quote(label)))
+    for edge in edges:
+        source, target, attr, link_type = edge
+        if link_type == 'client':
+            style = 'fontsize=8'
+        else:
+            style = 'style=dashed, fontsize=7'
+        lines.append(_quote(source) + ' -> ' + _quote(target) +
+                     ' [arrowsize=0.6, ' + style + ', label=' +
+                     _quote("{0} x{1}".format(attr, edge_counts[edge])) +
+                     '];')
+    lines.append('}')
+    return "\n".join(lines) + "\n"
+
+
+def build_graph_data(nodes, roles, show_hostnames, links):
+    """Returns the clusters, nodes and edges of a node map as JSON
+    serializable data, for graphs laid out by the browser
+
+    """
+    role_colors = _get_role_colors(roles)
+    colors = dict(role_colors)
+    cluster_nodes = dict((role, []) for role, color in role_colors)
+    graph_names = _get_graph_names(nodes, show_hostnames)
+    graph_nodes = []
+    edges = []
+    for node in nodes:
+        role_prefix = _get_role_prefix(node)
+        cluster_nodes[role_prefix].append(node['name'])
+        graph_nodes.append({'name': node['name'],
+                            'label': graph_names[node['name']],
+                            'cluster': role_prefix,
+                            'color': colors[role_prefix]})
+        node_links = links[node['name']]
+        for client in node_links.get('client_nodes', []):
+            edges.append({'source': client[0], 'target': node['name'],
+                          'label': client[1], 'type': 'client'})
+        for client in node_links.get('needs_nodes', []):
+            edges.append({'source': node['name'], 'target': client[0],
+                          'label': client[1], 'type': 'needs'})
+    clusters = [{'name': role, 'color': color, 'nodes': cluster_nodes[role]}
+                for role, color in role_colors]
+    return {'clusters': clusters, 'nodes': graph_nodes, 'edges': edges}
+
+
+def get_graph_data(snapshot, env, roles, show_hostnames=True):
+    """Returns the graph data of the given snapshot environment and roles,
+    along with the related roles outside them
+
+    """
+    env_nodes = snapshot.filter_nodes(env, virt_roles='guest')
+    env_links = get_env_links(snapshot, env)
+    nodes = env_nodes
+    if roles:
+        nodes = filter_nodes(env_nodes, roles=roles)
+    data = build_graph_data(nodes, snapshot.roles, show_hostnames,
+                            env_links.get_links(nodes))
+    data['related_roles'] = get_role_relations(env, roles, env_nodes,
+                                               env_links)
+    return data
+
+
+def collapse_roles(nodes):
+    """Returns whether a graph of the given nodes is too big to draw each
+    node, and should be drawn with one vertex per role
+
+    """
+    return (bool(GRAPH_COLLAPSE_THRESHOLD) and
+            len(nodes) > GRAPH_COLLAPSE_THRESHOLD)
+
+
+def _build_pydot_graph(nodes, roles, show_hostnames, links):
+    """Builds a node map out of pydot objects"""
     graph = KitchenDot(graph_type='digraph')
     clusters = {}
     graph_nodes = {}
 
     role_colors = {}
-    color_index = 0
-    role_groups = get_role_groups(roles) + ['none']
-    for role in role_groups:
+    for role, color in _get_role_colors(roles):
         clusters[role] = pydot.Cluster(
-            role, label=role, color=COLORS[color_index], fontsize="12")
+            role, label=role, color=color, fontsize="12")
         graph.add_subgraph(clusters[role])
-        role_colors[role] = COLORS[color_index]
-        color_index += 1
-        if color_index >= len(COLORS):
-            color_index = 0
+        role_colors[role] = color
 
     # Create nodes
     node_labels = {}  # Only used when show_hostnames = False
     for node in nodes:
-        color = "lightyellow"
         role_prefix = _get_role_prefix(node)
         color = role_colors[role_prefix]
-        label = "\n".join([role for role in node['role']
-                          if not role.startswith(REPO['EXCLUDE_ROLE_PREFIX'])])
-        if show_hostnames:
-            label = node['name'] + "\n" + label
-        else:
-            if not label:
-                label = "norole"
+        label = _get_node_label(node, show_hostnames)
+        if not show_hostnames:
             if label in node_labels:
                 if node_labels[label] == 1:
                     first_node = clusters[role_prefix].get_node(label)[0]
@@ -155,7 +490,6 @@ def generate_node_map(nodes, roles, show_hostnames=True):
                              fontsize="9")
         graph_nodes[node['name']] = node_el
         clusters[role_prefix].add_node(node_el)
-    links = _build_links(nodes)
     for node in links:
         for client in links[node].get('client_nodes', []):
             edge = pydot.Edge(
@@ -176,49 +510,264 @@ def generate_node_map(nodes, roles, show_hostnames=True):
             )
             edge.set_label(client[1])
             graph.add_edge(edge)
+    return graph
+
+
+def generate_node_map(nodes, roles, show_hostnames=True, env_links=None,
+                      timeout=RENDER_TIMEOUT, collapse=False, prog=None):
+    """Generates a graphviz node map. env_links may be given as the
+    EnvironmentLinks of an environment containing the nodes, which may then
+    be node records, as only their names and roles are read. When collapse
+    is set, nodes are grouped into one vertex per role. prog is the graphviz
+    layout program, one of GRAPH_LAYOUTS
 
-    # Generate graph
-    filename = os.path.join(STATIC_ROOT, 'img', 'node_map.svg')
-    timeout = 10.0  # Seconds
-    graph_thread = GraphThread(filename, graph)
-    graph_thread.start()
-    result = graph_thread.join(timeout)
-    if graph_thread.isAlive():
-        # Kill the pydot graphviz's subprocess
-        graph_thread.kill()
-        timeout = int(timeout)
-        log.error("pydot timeout: {0} seconds".format(timeout))
-        return False, ("Unable to draw graph, timeout exceeded "
-                       "({0} seconds)").format(timeout)
+    """
+    prog = prog or GRAPH_LAYOUTS[0]
+    if env_links is None:
+        links = _build_links(expand_nodes(nodes))
+    else:
+        links = env_links.get_links(nodes)
+    if collapse:
+        graph = SourceDot(write_role_graph_source(nodes, roles, links))
+    elif GRAPH_USE_PYDOT:
+        graph = _build_pydot_graph(nodes, roles, show_hostnames, links)
     else:
+        graph = SourceDot(
+            write_dot_source(nodes, roles, show_hostnames, links))
+    graph.set_prog(prog)
+
+    # Generate graph, unless an identical one was already rendered
+    filename = get_graph_filename(graph.to_string(), prog, 'svg')
+    if os.path.exists(filename):
+        try:
+            os.utime(filename, None)  # Keep it as recently used
+            return True, filename
+        except OSError:
+            pass  # Evicted meanwhile, or rendered by another user
+    return render_pool.render(filename, graph, timeout)
+
+
+def _prerender_graph(job):
+    """Renders the default graph of an environment. Runs in a worker
+    process, which shares the repository snapshot loaded before forking
+
+    """
+    env, show_hostnames = job
+    try:
+        snapshot = get_snapshot()
+        nodes = snapshot.filter_nodes(env, virt_roles='guest')
+        return generate_node_map(nodes, snapshot.roles, show_hostnames,
+                                 env_links=get_env_links(snapshot, env),
+                                 timeout=PRERENDER_TIMEOUT,
+                                 collapse=collapse_roles(nodes))
+    except RepoError as e:
+        return False, str(e)
+
+
+def prerender_graphs(processes=None):
+    """Renders the graphs the graph view shows for each environment when no
+    roles are selected, with and without host names, so that they are
+    served from the graph cache. Uses a pool of processes, as many as CPUs
+    by default
+
+    """
+    snapshot = get_snapshot()
+    jobs = [(env['name'], show_hostnames)
+            for env in snapshot.environments
+            for show_hostnames in [True, False]]
+    pool = Pool(processes)
+    try:
+        results = pool.map(_prerender_graph, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (env, show_hostnames), (success, msg) in zip(jobs, results):
+        if not success:
+            log.error("Unable to render the {0} graph: {1}".format(env, msg))
+    return dict(zip(jobs, results))
+
+
+def _get_cache_dir():
+    """Returns the directory where rendered graphs are cached"""
+    return os.path.join(STATIC_ROOT, GRAPH_CACHE_DIR)
+
+
+def get_graph_filename(source, prog, format):
+    """Returns the cache file for a graph rendered out of the given DOT
+    source, graphviz program and output format
+
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    key = hashlib.sha1("\n".join([prog, format, source])).hexdigest()
+    return os.path.join(_get_cache_dir(), "{0}.{1}".format(key, format))
+
+
+def get_graph_url(filename):
+    """Returns the static URL of a cached graph file"""
+    path = os.path.relpath(filename, STATIC_ROOT)
+    return STATIC_URL + path.replace(os.sep, '/')
+
+
+def evict_graphs():
+    """Removes the cached graphs older than GRAPH_CACHE_MAX_AGE, and then
+    the least recently used ones until the cache fits in GRAPH_CACHE_MAX_SIZE
+
+    """
+    cache_dir = _get_cache_dir()
+    try:
+        filenames = os.listdir(cache_dir)
+    except OSError:
+        return
+    renders = []
+    for filename in filenames:
+        if filename.startswith('.'):
+            continue  # Render in progress
+        path = os.path.join(cache_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        renders.append((stat.st_mtime, stat.st_size, path))
+    now = time.time()
+    total_size = 0
+    for mtime, size, path in sorted(renders, reverse=True):
+        total_size += size
+        if (now - mtime > GRAPH_CACHE_MAX_AGE or
+                total_size > GRAPH_CACHE_MAX_SIZE):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class RenderPool(object):
+    """Renders graphs in GraphThreads, running at most max_renders graphviz
+    processes at a time. Concurrent renders of the same file are coalesced
+    into a single one, whose result is returned to every caller. A render is
+    only killed once the last of its callers' deadlines has passed
+
+    """
+    def __init__(self, max_renders):
+        self._slots = threading.BoundedSemaphore(max_renders)
+        self._renders = {}
+        self._lock = threading.Lock()
+
+    def _start(self, filename, graph, deadline):
+        """Returns the running render of filename, starting it if needed,
+        and extends its deadline to the caller's
+
+        """
+        with self._lock:
+            graph_thread = self._renders.get(filename)
+            if graph_thread is None or graph_thread.done.is_set():
+                graph_thread = GraphThread(filename, graph, self._slots)
+                self._renders[filename] = graph_thread
+                graph_thread.start()
+            graph_thread.deadline = max(graph_thread.deadline, deadline)
+            return graph_thread
+
+    def _abandon(self, filename, graph_thread):
+        """Kills a render when no other caller is still waiting for it"""
+        with self._lock:
+            if time.time() < graph_thread.deadline:
+                return
+            # Kill the pydot graphviz's subprocess
+            graph_thread.kill()
+            if self._renders.get(filename) is graph_thread:
+                del self._renders[filename]
+
+    def _forget(self, filename, graph_thread):
+        """Removes a finished render from the running renders"""
+        with self._lock:
+            if self._renders.get(filename) is graph_thread:
+                del self._renders[filename]
+
+    def render(self, filename, graph, timeout):
+        """Renders the graph to filename, waiting at most timeout seconds,
+        time in the queue included
+
+        """
+        graph_thread = self._start(filename, graph, time.time() + timeout)
+        result = graph_thread.join(timeout)
+        if graph_thread.isAlive():
+            self._abandon(filename, graph_thread)
+            timeout = int(timeout)
+            log.error("pydot timeout: {0} seconds".format(timeout))
+            return False, ("Unable to draw graph, timeout exceeded "
+                           "({0} seconds)").format(timeout)
+        self._forget(filename, graph_thread)
+        evict_graphs()
         return result
 
 
 class GraphThread(threading.Thread):
-    """Thread for pydot graph generation. Wraphs the file creation"""
+    """Thread for pydot graph generation. Wraphs the file creation.
+    When given a semaphore, it is held while graphviz runs
 
-    def __init__(self, filename, graph):
+    """
+    def __init__(self, filename, graph, slots=None):
         self.filename = filename
         self.graph = graph
+        self.slots = slots
+        self.done = threading.Event()
+        # Latest time a caller waits for the render until
+        self.deadline = 0
+        self._killed = False
         self._return = False, "Unable to draw graph, unexpected error"
         threading.Thread.__init__(self)
+        self.daemon = True
 
     def run(self):
         try:
-            self.graph.write_svg(self.filename)
+            if self.slots is None:
+                self._render()
+            else:
+                with self.slots:
+                    if not self._killed:
+                        self._render()
+        finally:
+            self.done.set()
+
+    def _render(self):
+        # Render to a temporary file so that readers never see a partial graph
+        dirname = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        except OSError:
+            pass  # Created meanwhile by another render
+        try:
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix='.graph')
+            os.close(tmp_fd)
+        except OSError as e:
+            log.error("Unable to create graph file: {0}".format(str(e)))
+            return
+        try:
+            self.graph.render(tmp_name, 'svg')
+            os.chmod(tmp_name, 0644)
+            os.rename(tmp_name, self.filename)
         except pydot.InvocationException as e:
             log.error("pydot error: {0}".format(str(e)))
             self._return = False, "Unable to render the graph"
+        except OSError as e:
+            log.error("Unable to write graph file: {0}".format(str(e)))
         else:
             self._return = True, self.filename
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
 
     def join(self, timeout=None):
         threading.Thread.join(self, timeout)
         return self._return
 
     def kill(self):
-        if self.graph.p:
-            self.graph.p.kill()
+        self._killed = True
+        self.graph.kill()
+
+
+render_pool = RenderPool(GRAPH_MAX_RENDERS)
 
 
 class KitchenDot(pydot.Dot):
@@ -229,14 +778,34 @@ class KitchenDot(pydot.Dot):
     def __init__(self, *argsl, **argsd):
         super(KitchenDot, self).__init__(*argsl, **argsd)
         self.p = None
+        self._killed = False
+        self._p_lock = threading.Lock()
 
-    def create(self, prog=None, format='ps'):
-        """Creates and returns a Postscript representation of the graph."""
+    def _popen(self, cmdline, **kwargs):
+        """Starts the graphviz subprocess, unless the graph was killed"""
+        with self._p_lock:
+            if self._killed:
+                raise pydot.InvocationException("Render killed")
+            self.p = subprocess.Popen(cmdline, **kwargs)
+        return self.p
+
+    def kill(self):
+        """Kills the graphviz subprocess, or keeps it from being started"""
+        with self._p_lock:
+            self._killed = True
+            if self.p:
+                try:
+                    self.p.kill()
+                except OSError:
+                    pass  # Already finished
+
+    def _get_prog_cmdline(self, prog, format):
+        """Returns the command line running the given graphviz program"""
         if prog is None:
             prog = self.prog
 
         if isinstance(prog, (list, tuple)):
-            prog, args = prog[0], prog[1:]
+            prog, args = prog[0], list(prog[1:])
         else:
             args = []
 
@@ -256,6 +825,46 @@ class KitchenDot(pydot.Dot):
                 'GraphViz\'s executable "{0}" is not a file '
                 'or doesn\'t exist'.format(self.progs[prog]))
 
+        return [self.progs[prog], '-T' + format] + args
+
+    def _run(self, cmdline, stdout):
+        """Runs graphviz feeding the graph source through stdin, while
+        stderr is read at the same time, and returns stdout's output
+
+        """
+        source = self.to_string()
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        self._popen(
+            cmdline,
+            stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.PIPE
+        )
+        stdout_output, stderr_output = self.p.communicate(source)
+        status = self.p.returncode
+
+        if status != 0:
+            raise pydot.InvocationException(
+                'Program terminated with status: {0}. '
+                'stderr follows: {1}'.format(status, stderr_output))
+        elif stderr_output:
+            log.error(stderr_output)
+        return stdout_output
+
+    def render(self, path, format='svg', prog=None):
+        """Renders the graph, writing graphviz's output straight to path"""
+        if self.shape_files:
+            # Shape files need to be next to the graph source
+            return self.write(path, prog=prog, format=format)
+        cmdline = self._get_prog_cmdline(prog, format)
+        with open(path, 'wb') as f:
+            self._run(cmdline, f)
+
+    def create(self, prog=None, format='ps'):
+        """Creates and returns a Postscript representation of the graph."""
+        cmdline = self._get_prog_cmdline(prog, format)
+        if not self.shape_files:
+            return self._run(cmdline, subprocess.PIPE)
+
         tmp_fd, tmp_name = tempfile.mkstemp()
         os.close(tmp_fd)
         self.write(tmp_name)
@@ -273,40 +882,13 @@ class KitchenDot(pydot.Dot):
             f.write(f_data)
             f.close()
 
-        cmdline = [self.progs[prog], '-T' + format, tmp_name] + args
-
-        self.p = subprocess.Popen(
-            cmdline,
+        self._popen(
+            cmdline + [tmp_name],
             cwd=tmp_dir,
             stderr=subprocess.PIPE, stdout=subprocess.PIPE
         )
-
-        stderr = self.p.stderr
-        stdout = self.p.stdout
-
-        stdout_output = list()
-        while True:
-            data = stdout.read()
-            if not data:
-                break
-            stdout_output.append(data)
-        stdout.close()
-
-        stdout_output = ''.join(stdout_output)
-
-        if not stderr.closed:
-            stderr_output = list()
-            while True:
-                data = stderr.read()
-                if not data:
-                    break
-                stderr_output.append(data)
-            stderr.close()
-
-            if stderr_output:
-                stderr_output = ''.join(stderr_output)
-
-        status = self.p.wait()
+        stdout_output, stderr_output = self.p.communicate()
+        status = self.p.returncode
 
         if status != 0:
             raise pydot.InvocationException(
@@ -323,3 +905,14 @@ class KitchenDot(pydot.Dot):
         os.unlink(tmp_name)
 
         return stdout_output
+
+
+class SourceDot(KitchenDot):
+    """KitchenDot rendering an already written DOT source"""
+
+    def __init__(self, source, *argsl, **argsd):
+        super(SourceDot, self).__init__(*argsl, **argsd)
+        self.source = source
+
+    def to_string(self):
+        return self.source
@@ -0,0 +1,97 @@
+"""Server side processing of the node list, which is sorted, searched and
+sent to the browser one page at a time
+
+"""
+import re
+
+from kitchen.backends.display import get_display
+from kitchen.dashboard import fragments
+from kitchen.settings import SHOW_LINKS
+
+# Maximum number of rows returned in a page
+MAX_PAGE_LENGTH = 500
+# Number of columns with sortable text, starting with the expander column
+TEXT_COLUMNS = 8
+# Matches the cells of a rendered row, capturing their content
+CELL_PATTERN = re.compile(r'<td[^>]*>(.*?)</td>', re.DOTALL)
+
+
+def _get_column_texts(node):
+    """Returns the text of the sortable columns of a node row, by position"""
+    display = get_display(node)
+    return [u'', unicode(node['name']), unicode(node.get('hostname', '')),
+            unicode(node.get('ipaddress', '')),
+            unicode(node.get('chef_environment', '')),
+            u' '.join(display.roles), u', '.join(display.recipes),
+            u' '.join(tag for tag, btn_class in display.tags)]
+
+
+class ListRows(object):
+    """Lower cased sort and search texts of the rows of all nodes"""
+
+    def __init__(self, nodes):
+        self.columns = []
+        self.search_texts = []
+        for node in nodes:
+            texts = [text.lower() for text in _get_column_texts(node)]
+            self.columns.append(texts)
+            self.search_texts.append(u' '.join(texts))
+
+    def filter(self, positions, search):
+        """Returns the positions of the rows containing every word of the
+        search text
+
+        """
+        words = search.lower().split()
+        if not words:
+            return positions
+        return [i for i in positions
+                if all(word in self.search_texts[i] for word in words)]
+
+    def sort(self, positions, sorting):
+        """Returns the positions sorted by the given (column, descending)
+        pairs, the first one being the primary order
+
+        """
+        for column, descending in reversed(sorting):
+            if 0 < column < TEXT_COLUMNS:
+                positions = sorted(
+                    positions, key=lambda i: self.columns[i][column],
+                    reverse=descending)
+        return positions
+
+
+def render_cells(nodes):
+    """Returns the HTML cells of the rows of the given nodes, taken from the
+    rows the list template renders, which are shared with the list view
+    through the row cache
+
+    """
+    rows = fragments.render_row_list('list_row.html', nodes, SHOW_LINKS)
+    return [[cell.strip() for cell in CELL_PATTERN.findall(row)]
+            for row in rows]
+
+
+def get_page(snapshot, env='', roles=None, virt='', search='', sorting=None,
+             start=0, length=100):
+    """Returns the number of nodes which fulfill env, roles and virt
+    criteria, the number of those matching the search text, and the cells
+    and node digests of the requested page of them. A length of 0 or less,
+    such as the -1 DataTables sends, requests all rows. Otherwise at most
+    MAX_PAGE_LENGTH rows are returned
+
+    """
+    rows = snapshot.get_cached('list_rows',
+                               lambda: ListRows(snapshot.nodes_extended))
+    positions = snapshot.index.filter_ids(env, roles, virt)
+    total = len(positions)
+    positions = rows.filter(positions, search)
+    positions = rows.sort(positions, sorting or [])
+    if length <= 0:
+        length = len(positions)
+    else:
+        length = min(length, MAX_PAGE_LENGTH)
+    page = [snapshot.nodes_extended[i] for i in positions[start:start + length]]
+    cells = render_cells(page)
+    digests = [node['digest'] for node in page]
+    return total, len(positions), cells, digests
@@ -39,29 +39,40 @@ function getSearchText() {
     return searchText;
 }
 
-function drawNodeListTable(searchText) {
+function drawNodeListTable(searchText, sAjaxSource) {
     /*
-     * Creates a list of nodes DataTable
+     * Creates a list of nodes DataTable. When an ajax source is given, rows
+     * are requested page by page from the server
      */
-    oTable = $('#nodes').dataTable(getDefaultDataTableConfig());
+    var dataTableConfig = getDefaultDataTableConfig();
+    if (sAjaxSource !== undefined) {
+        dataTableConfig['bServerSide'] = true;
+        dataTableConfig['sAjaxSource'] = sAjaxSource;
+        dataTableConfig['bPaginate'] = true;
+        dataTableConfig['iDisplayLength'] = 100;
+        dataTableConfig['aoColumnDefs'].push({ "sClass": "control", "aTargets": [0] });
+        var digests = [];
+        dataTableConfig['fnServerData'] = function (sSource, aoData, fnCallback) {
+            $.getJSON(sSource, aoData, function (json) {
+                digests = json['digests'];  // Used to request node details
+                fnCallback(json);
+            });
+        };
+        dataTableConfig['fnCreatedRow'] = function (nRow, aData, iDataIndex) {
+            $(nRow).attr('data-digest', digests[iDataIndex]);
+        };
+        dataTableConfig['fnDrawCallback'] = function (oSettings) {
+            $('#nodes td.control').html('<i class="icon-chevron-right"></i>');
+        };
+    }
+    oTable = $('#nodes').dataTable(dataTableConfig);
     setSearchBox();
     setExtendedRows(oTable);
 }
 
-function buildProgressBar(nodeid, total) {
+function buildProgressBar(guest_memory, total) {
     var memory_usage = 1048576  // kB, minimum for the host
-    NODES.forEach(function(node) {
-        if (nodeid == node['name']) {
-            if (node['virtualization'] != undefined && node['virtualization']['guests'] != undefined) {
-                node['virtualization']['guests'].forEach(function(guest) {
-                    if (guest['memory'] != undefined && guest['memory']['total'] != undefined) {
-                        memory_usage += parseInt(guest['memory']['total'].replace("kB", ''));
-                    }
-                });
-            }
-            return;
-        }
-    });
+    memory_usage += parseInt(guest_memory) || 0;
     memory_usage = parseInt(memory_usage / 1048576);
 
     var status = "";
@@ -109,7 +120,7 @@ function drawNodeVirtTable(searchText) {
                 nCell.className = "host-grouper";
                 sLastGroup = sGroup;
                 sGroup += buildProgressBar(
-                    oSettings.aoData[oSettings.aiDisplay[iDisplayIndex]]._aData[1],
+                    $(nTrs[i]).attr('data-guest-memory'),
                     oSettings.aoData[oSettings.aiDisplay[iDisplayIndex]]._aData[5].split(" ")[0]
                 );
                 nCell.innerHTML = sGroup;
@@ -151,22 +162,26 @@ function setExtendedRows(oTable) {
 
 function fnFormatNodeDetails (oTable, nTr) {
     /* 
-     * Establishes the content of the extended row.
+     * Establishes the content of the extended row, filled in once the node
+     * is loaded. Requested along with its digest, the node can be cached.
      * The node key in DataTables will always be placed in the index 1 column.
      */
     var aData = oTable.fnGetData(nTr);
-    var node = undefined;
-    for(var i=0;i<NODES.length;i++) {
-        if (NODES[i].name.substring(0, aData[1].length) == aData[1]) {
-            node = NODES[i];
-            break;
-        }
+    var name = $('<div/>').html(aData[1]).text();
+    var url = '/api/details/' + encodeURIComponent(name);
+    var digest = $(nTr).attr('data-digest');
+    if (digest) {
+        url += '?v=' + digest;
     }
-    var sOut = '<pre>';
-    nodeJson = syntaxHighlight(JSON.stringify(node, undefined, 4));
-    sOut += nodeJson;
-    sOut += '</pre>';
-    return sOut;
+    var details = $('<pre>Loading...</pre>');
+    $.ajax({ url: url, dataType: 'json', cache: true })
+        .done(function (node) {
+            details.html(syntaxHighlight(JSON.stringify(node, undefined, 4)));
+        })
+        .fail(function () {
+            details.text('No details found for ' + name);
+        });
+    return details[0];
 }
 
 function syntaxHighlight(json) {
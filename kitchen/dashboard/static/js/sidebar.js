@@ -13,6 +13,7 @@ function setupClickHandlers() {
         }
         var changed_environment = false;
         var changed_virt = false;
+        var changed_layout = false;
         // Add already selected buttons to the params
         for (var i=0; i < active_buttons.length; i++) {
             var datatype = active_buttons[i].dataset['type'];
@@ -31,6 +32,13 @@ function setupClickHandlers() {
                 } else if (!changed_virt) {
                     parameters[datatype] = dataname;
                 }
+            } else if (datatype === 'layout') {
+                if (active_buttons[i] === this) {
+                    parameters[datatype] = dataname;
+                    changed_layout = true;
+                } else if (!changed_layout) {
+                    parameters[datatype] = dataname;
+                }
             } else {
                 if (datatype in parameters && datatype !== 'env') {
                     parameters[datatype] += ',' + dataname;
@@ -1,26 +1,48 @@
 """Tests for the kitchen.dashboard app"""
 import os
+import time
+import shutil
+import tempfile
+import threading
 
 import simplejson as json
 from django.test import TestCase
 from mock import patch
 
 from kitchen.backends import lchef as chef, plugins
-from kitchen.dashboard import views, graphs
+from kitchen.backends.records import NodeRecord
+from kitchen.backends.display import NodeDisplay
+from kitchen.dashboard import views, graphs, rows, fragments, api
 from kitchen.dashboard.templatetags import filters
-from kitchen.settings import STATIC_ROOT, REPO, ENABLE_PLUGINS
+from kitchen.settings import REPO, ENABLE_PLUGINS, SHOW_LINKS
 
 # We need to always regenerate the node data bag in case there where changes
 chef.build_node_data_bag()
 TOTAL_NODES = 10
 
 
-class TestViews(TestCase):
-    filepath = os.path.join(STATIC_ROOT, 'img', 'node_map.svg')
+class GraphCacheTestCase(TestCase):
+    """Renders graphs into a temporary static dir"""
 
     def setUp(self):
-        if os.path.exists(self.filepath):
-            os.remove(self.filepath)
+        self.static_root = tempfile.mkdtemp()
+        self.patcher = patch('kitchen.dashboard.graphs.STATIC_ROOT',
+                             self.static_root)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.static_root)
+
+    def _rendered_graphs(self):
+        """Returns the graph files in the graph cache"""
+        cache_dir = graphs._get_cache_dir()
+        if not os.path.isdir(cache_dir):
+            return []
+        return os.listdir(cache_dir)
+
+
+class TestViews(GraphCacheTestCase):
 
     @patch('kitchen.backends.lchef.KITCHEN_DIR', '/badrepopath/')
     def test_list_no_repo(self):
@@ -38,11 +60,59 @@ class TestViews(TestCase):
         self.assertTrue("<title>Kitchen</title>" in resp.content)
         self.assertTrue("Environment" in resp.content)
         self.assertTrue("Roles" in resp.content)
+
+    def test_list_no_embedded_nodes(self):
+        """Should give rows the digest to request node details with, instead
+        of embedding the nodes in the page
+
+        """
+        resp = self.client.get("/")
+        self.assertFalse("NODES" in resp.content)
+        self.assertFalse('"automatic"' in resp.content)
+        digest = chef.get_snapshot().get_node_digest('testnode2')
+        self.assertTrue('<tr data-digest="{0}">'.format(digest)
+                        in resp.content)
+
+    def test_virt_guest_memory(self):
+        """Should give virt rows the memory of the guests of their host"""
+        resp = self.client.get("/virt/?env=staging")
+        self.assertFalse("NODES" in resp.content)
+        self.assertTrue('data-guest-memory="12043000"' in resp.content)
+
+    def test_list_etag(self):
+        """Should answer with a 304 when the list is still current"""
+        etag = self.client.get("/?env=production")['ETag']
+        resp = self.client.get("/?env=production", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_list_etag_sync_warning(self):
+        """Should give a new ETag when the sync warning changes"""
+        etag = self.client.get("/")['ETag']
+        with patch('kitchen.dashboard.views._get_sync_age', lambda: 100):
+            resp = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("Last pull was 100 minutes ago" in resp.content)
         # 3 nodes in the production environment, which is default
         nodes = ["testnode" + str(i) for i in range(1, 4)]
         for node in nodes:
             self.assertTrue(node in resp.content, node)
 
+    def test_list_if_modified_since(self):
+        """Should only validate pages with their ETag, as they change when
+        the sync warning does
+
+        """
+        resp = self.client.get("/")
+        self.assertFalse(resp.has_header('Last-Modified'))
+        resp = self.client.get("/", HTTP_IF_MODIFIED_SINCE=
+                               'Sun, 09 Sep 2035 01:46:40 GMT')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_graph_not_conditional(self):
+        """Should always render the graph page, whose graph may be evicted"""
+        resp = self.client.get("/graph/?env=production")
+        self.assertFalse(resp.has_header('ETag'))
+
     def test_list_env(self):
         """Should display proper nodes when an environment is given"""
         resp = self.client.get("/?env=staging&virt=")
@@ -98,6 +168,19 @@ class TestViews(TestCase):
         self.assertTrue('href="http://testnode1:22002"' not in resp.content)
         self.assertTrue('src="http://haproxy.1wt.eu/img' not in resp.content)
 
+    def test_list_server_side(self):
+        """Should leave nodes out of the list page when the repository is
+        above the server side threshold
+
+        """
+        with patch.object(views, 'LIST_SERVER_SIDE_THRESHOLD', 5):
+            resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('<table id="nodes"' in resp.content)
+        self.assertTrue("/api/rows" in resp.content)
+        self.assertFalse("testnode2" in resp.content)
+        self.assertFalse("There are no nodes" in resp.content)
+
     def test_virt(self):
         """Should display nodes when repo is correct"""
         resp = self.client.get("/virt/")
@@ -113,6 +196,12 @@ class TestViews(TestCase):
         self.assertTrue(
             'btn-custom btn-danger disabled">dummy<' in resp.content)
 
+    def test_virt_guest_resources(self):
+        """Should display the memory and cpus of guests listed by hosts"""
+        resp = self.client.get("/virt/")
+        self.assertTrue('<td class="node_ram">6 GB</td>' in resp.content)
+        self.assertTrue('<td class="node_cpus">4</td>' in resp.content)
+
     def test_virt_links(self):
         """Should display links when selected nodes have links"""
         resp = self.client.get("/virt/")
@@ -136,10 +225,10 @@ class TestViews(TestCase):
         self.assertTrue("<title>Kitchen</title>" in resp.content)
         self.assertTrue("Environment" in resp.content)
         self.assertTrue("Please select an environment" in resp.content)
-        self.assertFalse('<img src="/static/img/node_map.svg"' in resp.content)
+        self.assertFalse('src="/static/img/graphs/' in resp.content)
         self.assertTrue("webserver" in resp.content)
         self.assertTrue("staging" in resp.content)
-        self.assertFalse(os.path.exists(self.filepath))
+        self.assertEqual(self._rendered_graphs(), [])
         self.assertFalse("Hidden relationships: " in resp.content)
 
     @patch('kitchen.backends.lchef.KITCHEN_DIR', '/badrepopath/')
@@ -155,7 +244,7 @@ class TestViews(TestCase):
         error_msg = "GraphVizs executables not found"
 
         def mock_factory():
-            def mock_method(a, b, c):
+            def mock_method(a, b, c, **kwargs):
                 return False, error_msg
             return mock_method
         with patch.object(graphs, 'generate_node_map',
@@ -164,7 +253,9 @@ class TestViews(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertTrue(error_msg in resp.content,
                         "Did not find expected string '{0}'".format(error_msg))
-        self.assertFalse(os.path.exists(self.filepath))
+        self.assertEqual(self._rendered_graphs(), [])
+        self.assertEqual(resp['Cache-Control'], 'no-store')
+        self.assertFalse(resp.has_header('ETag'))
 
     def test_graph_extra_roles_display(self):
         """Should display an extra roles message when graph detects new relations"""
@@ -178,6 +269,25 @@ class TestViews(TestCase):
                         'class="sidebar_link" id="related_role">worker'
                         '</a>' in resp.content)
 
+    def test_graph_layout_and_collapse(self):
+        """Should group nodes by role above the threshold and render with
+        the selected layout
+
+        """
+        with patch.object(graphs, 'generate_node_map',
+                          return_value=(True, 'graph.svg')) as mock_method:
+            with patch.object(graphs, 'GRAPH_COLLAPSE_THRESHOLD', 2):
+                resp = self.client.get("/graph/?env=production&layout=sfdp")
+            self.assertEqual(mock_method.call_args[1]['prog'], 'sfdp')
+            self.assertTrue(mock_method.call_args[1]['collapse'])
+            self.assertTrue("Nodes are grouped by role" in resp.content)
+            self.client.get("/graph/?env=production&layout=bad")
+            self.assertEqual(mock_method.call_args[1]['prog'], 'dot')
+            self.assertFalse(mock_method.call_args[1]['collapse'])
+            self.client.get(
+                "/graph/?env=production&options=collapse_roles")
+            self.assertTrue(mock_method.call_args[1]['collapse'])
+
     def test_graph_extra_roles_no_display_when_no_roles(self):
         """Should not display an extra roles message when there are no given roles"""
         resp = self.client.get("/graph/?env=production&roles=")
@@ -235,14 +345,9 @@ class TestPluginViews(TestCase):
             resp['location'], 'http://monitoring.mydomain.com/testnode1')
 
 
-class TestGraph(TestCase):
+class TestGraph(GraphCacheTestCase):
     nodes = chef.get_nodes_extended()
     roles = chef.get_roles()
-    filepath = os.path.join(STATIC_ROOT, 'img', 'node_map.svg')
-
-    def setUp(self):
-        if os.path.exists(self.filepath):
-            os.remove(self.filepath)
 
     def test_build_links_empty(self):
         """Should not generate links when nodes do not have any defined"""
@@ -321,12 +426,40 @@ class TestGraph(TestCase):
         }
         self.assertEqual(links, expected)
 
+    def test_build_links_same_as_scan(self):
+        """Should generate the links a scan over all node pairs generates"""
+        nodes = [
+            {'name': 'a', 'roles': ['db', 'db'], 'x': 'string', 'y': None},
+            {'name': 'b', 'roles': ['web'],
+             'mysql': {'client_roles': ['db'], 'needs_roles': ['web', 'db']},
+             'apache2': {'client_roles': ['web', 'missing']}},
+            {'name': 'c', 'roles': ['web', 'db'], 'lst': [1, 2],
+             'mysql': {'needs_roles': ['db']}},
+        ]
+        expected = {}
+        for node in nodes:
+            links = {}
+            for attr in node.keys():
+                for key, link_type in [('client_roles', 'client_nodes'),
+                                       ('needs_roles', 'needs_nodes')]:
+                    try:
+                        roles = node[attr][key]
+                    except (TypeError, KeyError):
+                        continue
+                    for other in nodes:
+                        if set(roles).intersection(other['roles']):
+                            links.setdefault(link_type, []).append(
+                                (other['name'], attr))
+            links['role_prefix'] = 'none'
+            expected[node['name']] = links
+        self.assertEqual(graphs._build_links(nodes), expected)
+
     def test_generate_empty_graph(self):
         """Should generate an empty graph when no nodes are given"""
         data = chef.filter_nodes(self.nodes, 'badenv')
-        graphs.generate_node_map(data, self.roles)
-        self.assertTrue(os.path.exists(self.filepath))
-        size = os.path.getsize(self.filepath)
+        success, filename = graphs.generate_node_map(data, self.roles)
+        self.assertTrue(success, filename)
+        size = os.path.getsize(filename)
         max_size = 650
         self.assertTrue(size < max_size,
                         "Size greater than {0}: {1}".format(max_size, size))
@@ -334,9 +467,9 @@ class TestGraph(TestCase):
     def test_generate_small_graph(self):
         """Should generate a graph when some nodes are given"""
         data = chef.filter_nodes(self.nodes, 'staging', virt_roles='guest')
-        graphs.generate_node_map(data, self.roles)
-        self.assertTrue(os.path.exists(self.filepath))
-        size = os.path.getsize(self.filepath)
+        success, filename = graphs.generate_node_map(data, self.roles)
+        self.assertTrue(success, filename)
+        size = os.path.getsize(filename)
         #min_size = 3000  # png
         #max_size = 4000  # png
         min_size = 1000  # svg
@@ -348,9 +481,9 @@ class TestGraph(TestCase):
     def test_generate_connected_graph(self):
         """Should generate a connected graph when connected nodes are given"""
         data = chef.filter_nodes(self.nodes, 'production', virt_roles='guest')
-        graphs.generate_node_map(data, self.roles)
-        self.assertTrue(os.path.exists(self.filepath))
-        size = os.path.getsize(self.filepath)
+        success, filename = graphs.generate_node_map(data, self.roles)
+        self.assertTrue(success, filename)
+        size = os.path.getsize(filename)
         # Graph size with connections
         #min_size = 20000  # png
         #max_size = 23000  # png
@@ -374,6 +507,344 @@ class TestGraph(TestCase):
         self.assertFalse(success)
         self.assertTrue(error_msg in msg)
 
+    def test_generate_graph_cached(self):
+        """Should serve an identical graph from the cache without rendering"""
+        data = chef.filter_nodes(self.nodes, 'staging', virt_roles='guest')
+        graph = graphs.KitchenDot(graph_type='digraph')
+        filename = graphs.get_graph_filename(graph.to_string(), 'dot', 'svg')
+        with patch.object(graphs, 'GraphThread') as mock_thread:
+            mock_thread.return_value.isAlive.return_value = False
+            mock_thread.return_value.join.return_value = True, 'rendered'
+            self.assertEqual(graphs.generate_node_map(data, self.roles),
+                             (True, 'rendered'))
+            rendered = mock_thread.call_args[0][0]
+            os.makedirs(os.path.dirname(rendered))
+            with open(rendered, 'w') as f:
+                f.write('<svg/>')
+            mock_thread.reset_mock()
+            self.assertEqual(graphs.generate_node_map(data, self.roles),
+                             (True, rendered))
+            self.assertFalse(mock_thread.called)
+        self.assertNotEqual(rendered, filename)
+        self.assertTrue(rendered.startswith(graphs._get_cache_dir()))
+        self.assertEqual(graphs.get_graph_url(rendered),
+                         '/static/img/graphs/' + os.path.basename(rendered))
+
+    def test_generate_graph_cached_utime_error(self):
+        """Should render the graph again when the cached file can't be
+        touched
+
+        """
+        data = chef.filter_nodes(self.nodes, 'staging', virt_roles='guest')
+        with patch.object(graphs.os.path, 'exists', return_value=True):
+            with patch.object(graphs.os, 'utime', side_effect=OSError):
+                with patch.object(graphs.render_pool, 'render',
+                                  return_value=(True, 'rendered')) as render:
+                    self.assertEqual(
+                        graphs.generate_node_map(data, self.roles),
+                        (True, 'rendered'))
+        self.assertTrue(render.called)
+
+    def test_graph_filename_options(self):
+        """Should use different cache files for different render options"""
+        self.assertNotEqual(graphs.get_graph_filename('graph', 'dot', 'svg'),
+                            graphs.get_graph_filename('graph', 'sfdp', 'svg'))
+        self.assertNotEqual(graphs.get_graph_filename('graph', 'dot', 'svg'),
+                            graphs.get_graph_filename('graph2', 'dot', 'svg'))
+
+    def test_evict_graphs(self):
+        """Should evict old graphs and least recently used graphs above the
+        cache size limit
+
+        """
+        cache_dir = graphs._get_cache_dir()
+        os.makedirs(cache_dir)
+        now = time.time()
+        for name, age in [('old', 3600), ('older', 7200), ('new', 0),
+                          ('expired', 100000)]:
+            path = os.path.join(cache_dir, name + '.svg')
+            with open(path, 'w') as f:
+                f.write('x' * 10)
+            os.utime(path, (now - age, now - age))
+        with patch.object(graphs, 'GRAPH_CACHE_MAX_AGE', 10000):
+            with patch.object(graphs, 'GRAPH_CACHE_MAX_SIZE', 25):
+                graphs.evict_graphs()
+        self.assertEqual(sorted(self._rendered_graphs()),
+                         ['new.svg', 'old.svg'])
+
+    def test_render_pool_coalesces_renders(self):
+        """Should render concurrent requests of the same graph only once"""
+        release = threading.Event()
+        renders = []
+
+        class SlowGraph(object):
+            p = None
+
+            def render(self, path, format):
+                renders.append(path)
+                release.wait(5)
+                with open(path, 'w') as f:
+                    f.write('<svg/>')
+
+        pool = graphs.RenderPool(2)
+        filename = os.path.join(graphs._get_cache_dir(), 'graph.svg')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            pool.render(filename, SlowGraph(), 5))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(results, [(True, filename)] * 4)
+        self.assertTrue(os.path.exists(filename))
+
+    def test_render_pool_timeout_keeps_waiters(self):
+        """Should only kill a shared render once no caller waits for it"""
+        release = threading.Event()
+        kills = []
+
+        class SlowGraph(object):
+            p = None
+
+            def render(self, path, format):
+                release.wait(5)
+                if not kills:
+                    with open(path, 'w') as f:
+                        f.write('<svg/>')
+
+        pool = graphs.RenderPool(2)
+        filename = os.path.join(graphs._get_cache_dir(), 'graph.svg')
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            pool.render(filename, SlowGraph(), 5)))
+        waiter.start()
+        time.sleep(0.05)
+        with patch.object(graphs.GraphThread, 'kill',
+                          lambda graph_thread: kills.append(graph_thread)):
+            success, msg = pool.render(filename, SlowGraph(), 0.1)
+            self.assertFalse(success)
+            self.assertEqual(kills, [])
+            release.set()
+            waiter.join()
+            self.assertEqual(results, [(True, filename)])
+            release.clear()
+            self.assertFalse(pool.render(
+                os.path.join(graphs._get_cache_dir(), 'other.svg'),
+                SlowGraph(), 0.1)[0])
+            self.assertEqual(len(kills), 1)
+            release.set()
+            kills[0].join(5)
+
+    def test_render_pool_limit(self):
+        """Should not run more renders at once than the pool allows"""
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        class Graph(object):
+            p = None
+
+            def render(self, path, format):
+                with lock:
+                    running.append(path)
+                    max_running.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(path)
+
+        pool = graphs.RenderPool(2)
+        cache_dir = graphs._get_cache_dir()
+        threads = [threading.Thread(target=pool.render, args=(
+            os.path.join(cache_dir, '{0}.svg'.format(i)), Graph(), 5))
+            for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(max_running), 6)
+        self.assertEqual(max(max_running), 2)
+
+    def test_kitchendot_render(self):
+        """Should pipe the graph source to graphviz and write its output to
+        the given file, even when graphviz writes a lot to stderr
+
+        """
+        prog = os.path.join(self.static_root, 'dot')
+        with open(prog, 'w') as f:
+            f.write('#!/bin/sh\nhead -c 200000 /dev/zero >&2\ncat\n')
+        os.chmod(prog, 0755)
+        graph = graphs.KitchenDot(graph_type='digraph')
+        graph.add_node(graphs.pydot.Node('testnode'))
+        graph.progs = {'dot': prog}
+        path = os.path.join(self.static_root, 'graph.svg')
+        with patch.object(graphs.log, 'error'):
+            graph.render(path, 'svg')
+        with open(path) as f:
+            self.assertEqual(f.read(), graph.to_string())
+
+    def test_kitchendot_render_error(self):
+        """Should raise an InvocationException when graphviz fails"""
+        graph = graphs.KitchenDot(graph_type='digraph')
+        graph.progs = {'dot': '/bin/false'}
+        path = os.path.join(self.static_root, 'graph.svg')
+        self.assertRaises(graphs.pydot.InvocationException,
+                          graph.render, path, 'svg')
+
+    def test_kitchendot_killed_before_start(self):
+        """Should not start graphviz for a graph killed before its render"""
+        graph = graphs.KitchenDot(graph_type='digraph')
+        graph.progs = {'dot': '/bin/cat'}
+        graph.kill()
+        path = os.path.join(self.static_root, 'graph.svg')
+        with patch.object(graphs.subprocess, 'Popen') as mock_popen:
+            self.assertRaises(graphs.pydot.InvocationException,
+                              graph.render, path, 'svg')
+        self.assertFalse(mock_popen.called)
+
+    def _parse_graph(self, source):
+        """Returns the clusters, nodes and edges of a DOT source"""
+        def unquote(value):
+            return value.strip('"')
+
+        def attrs(element):
+            return sorted((key, unquote(str(value))) for key, value
+                          in element.get_attributes().items())
+        graph = graphs.pydot.graph_from_dot_data(source)
+        clusters = []
+        for cluster in graph.get_subgraph_list():
+            clusters.append((unquote(cluster.get_name()), attrs(cluster),
+                             [(unquote(node.get_name()), attrs(node))
+                              for node in cluster.get_nodes()]))
+        edges = sorted((unquote(edge.get_source()),
+                        unquote(edge.get_destination()), attrs(edge))
+                       for edge in graph.get_edges())
+        return sorted(clusters), edges
+
+    def test_write_dot_source_same_as_pydot(self):
+        """Should write the same graph pydot generates"""
+        for env in ['production', 'staging']:
+            data = chef.filter_nodes(self.nodes, env, virt_roles='guest')
+            links = graphs._build_links(data)
+            for show_hostnames in [True, False]:
+                source = graphs.write_dot_source(data, self.roles,
+                                                 show_hostnames, links)
+                graph = graphs._build_pydot_graph(data, self.roles,
+                                                  show_hostnames, links)
+                self.assertEqual(self._parse_graph(source),
+                                 self._parse_graph(graph.to_string()))
+
+    def test_generate_node_map_pydot(self):
+        """Should render pydot graphs when GRAPH_USE_PYDOT is set"""
+        data = chef.filter_nodes(self.nodes, 'production', virt_roles='guest')
+        with patch.object(graphs.render_pool, 'render') as mock_render:
+            with patch.object(graphs, 'GRAPH_USE_PYDOT', True):
+                graphs.generate_node_map(data, self.roles)
+            self.assertFalse(isinstance(mock_render.call_args[0][1],
+                                        graphs.SourceDot))
+            graphs.generate_node_map(data, self.roles)
+            self.assertTrue(isinstance(mock_render.call_args[0][1],
+                                       graphs.SourceDot))
+
+    def test_prerender_graphs(self):
+        """Should render the graphs the graph view shows for each
+        environment into the graph cache
+
+        """
+        def render(filename, graph, timeout):
+            return True, filename
+        with patch.object(graphs.render_pool, 'render', side_effect=render):
+            results = graphs.prerender_graphs(2)
+            self.assertEqual(len(results), 6)
+            for show_hostnames in [True, False]:
+                options = 'show_hostnames' if show_hostnames else ''
+                resp = self.client.get(
+                    "/graph/?env=production&options=" + options)
+                success, filename = results['production', show_hostnames]
+                self.assertTrue(success)
+                self.assertTrue(graphs.get_graph_url(filename) in
+                                resp.content)
+        self.assertNotEqual(results['production', True],
+                            results['production', False])
+
+    def test_dependency_index(self):
+        """Should find dependencies transitively in both directions"""
+        prod_nodes = chef.filter_nodes(self.nodes, 'production',
+                                       virt_roles='guest')
+        index = graphs.DependencyIndex(graphs.EnvironmentLinks(prod_nodes))
+        self.assertEqual(index.dependencies['testnode1'],
+                         set(['testnode2', 'testnode7']))
+        self.assertEqual(index.dependents['testnode3.mydomain.com'],
+                         set(['testnode2', 'testnode7', 'testnode8']))
+        self.assertEqual(index.search('worker')['nodes'], [])
+        self.assertEqual(index.search('worker', direction='upstream'),
+                         {'roles': ['dbserver'], 'nodes': [
+                             {'name': 'testnode3.mydomain.com',
+                              'role': 'dbserver', 'distance': 1}]})
+        self.assertEqual(index.search('badrole'), {'roles': [], 'nodes': []})
+        self.assertEqual(index.search(node='badnode'),
+                         {'roles': [], 'nodes': []})
+
+    def test_dependency_index_secondary_roles(self):
+        """Should find the dependencies of every role of a node, by full
+        role name or prefix
+
+        """
+        nodes = [
+            {'name': 'web1', 'role': ['webserver', 'dbserver'],
+             'roles': ['webserver', 'dbserver']},
+            {'name': 'replica1', 'role': ['dbserver_replica'],
+             'roles': ['dbserver_replica']},
+            {'name': 'worker1', 'role': ['worker'], 'roles': ['worker'],
+             'mysql': {'needs_roles': ['dbserver']},
+             'backup': {'needs_roles': ['dbserver_replica']}}]
+        index = graphs.DependencyIndex(graphs.EnvironmentLinks(nodes))
+        worker = {'name': 'worker1', 'role': 'worker', 'distance': 1}
+        self.assertEqual(index.search('dbserver'),
+                         {'roles': ['worker'], 'nodes': [worker]})
+        self.assertEqual(index.search('dbserver_replica'),
+                         {'roles': ['worker'], 'nodes': [worker]})
+        self.assertEqual(index.search('webserver'),
+                         {'roles': ['worker'], 'nodes': [worker]})
+
+    def test_write_role_graph_source(self):
+        """Should write one vertex per role and aggregated edges"""
+        data = chef.filter_nodes(self.nodes, 'production', virt_roles='guest')
+        source = graphs.write_role_graph_source(
+            data, self.roles, graphs._build_links(data))
+        clusters, edges = self._parse_graph(source)
+        self.assertEqual(clusters, [])
+        self.assertTrue('label="webserver\\n2 nodes"' in source)
+        self.assertTrue('label="dbserver\\n1 node"' in source)
+        self.assertEqual(
+            [(src, dst, dict(attrs)['label']) for src, dst, attrs in edges],
+            [('loadbalancer', 'webserver', 'apache2 x2'),
+             ('webserver', 'dbserver', 'mysql x2'),
+             ('worker', 'dbserver', 'mysql x1')])
+
+    def test_generate_node_map_collapsed(self):
+        """Should render role graphs with the given layout program"""
+        data = chef.filter_nodes(self.nodes, 'production', virt_roles='guest')
+        with patch.object(graphs.render_pool, 'render') as mock_render:
+            graphs.generate_node_map(data, self.roles, collapse=True,
+                                     prog='sfdp')
+        filename, graph, timeout = mock_render.call_args[0]
+        self.assertEqual(graph.prog, 'sfdp')
+        self.assertEqual(
+            filename, graphs.get_graph_filename(graph.to_string(), 'sfdp',
+                                                'svg'))
+        self.assertTrue('2 nodes' in graph.to_string())
+
+    def test_collapse_roles(self):
+        """Should collapse graphs of more nodes than the threshold"""
+        with patch.object(graphs, 'GRAPH_COLLAPSE_THRESHOLD', 2):
+            self.assertFalse(graphs.collapse_roles([{}, {}]))
+            self.assertTrue(graphs.collapse_roles([{}, {}, {}]))
+        with patch.object(graphs, 'GRAPH_COLLAPSE_THRESHOLD', 0):
+            self.assertFalse(graphs.collapse_roles([{}, {}, {}]))
+
     def test_get_role_relations(self):
         """Should return role dependencies when roles with relationships are given"""
         prod_nodes = chef.filter_nodes(self.nodes, 'production')
@@ -390,6 +861,62 @@ class TestGraph(TestCase):
                                                 prod_nodes)
         self.assertEqual(extra_roles, ['dbserver', 'loadbalancer'])
 
+    def test_environment_links_subset(self):
+        """Should return the links _build_links returns for any env subset"""
+        prod_nodes = chef.filter_nodes(self.nodes, 'production')
+        env_links = graphs.EnvironmentLinks(prod_nodes)
+        self.assertEqual(env_links.get_links(prod_nodes),
+                         graphs._build_links(prod_nodes))
+        for roles in [['dbserver'], ['webserver', 'worker'], ['badrole']]:
+            nodes = chef.filter_nodes(prod_nodes, roles=roles)
+            self.assertEqual(env_links.get_links(nodes),
+                             graphs._build_links(nodes))
+
+    def test_get_role_relations_shared_links(self):
+        """Should return the same role dependencies using shared links"""
+        prod_nodes = chef.filter_nodes(self.nodes, 'production')
+        env_links = graphs.EnvironmentLinks(prod_nodes)
+        for roles in [['dbserver'], ['loadbalancer'], ['worker'],
+                      ['webserver'], ['dbserver', 'worker']]:
+            self.assertEqual(
+                graphs.get_role_relations('production', roles, prod_nodes,
+                                          env_links),
+                graphs.get_role_relations('production', roles, prod_nodes))
+
+    def test_get_graph_data_decodes_once(self):
+        """Should only decode node records to build the environment links"""
+        chef.invalidate_snapshot()
+        snapshot = chef.get_snapshot()
+        env_nodes = snapshot.filter_nodes('production', virt_roles='guest')
+        with patch.object(NodeRecord, 'attributes',
+                          autospec=True,
+                          side_effect=NodeRecord.attributes) as attributes:
+            data = graphs.get_graph_data(snapshot, 'production',
+                                         ['dbserver'])
+            graphs.get_graph_data(snapshot, 'production', [])
+            graphs.get_dependency_index(snapshot, 'production')
+        self.assertEqual(attributes.call_count, len(env_nodes))
+        self.assertEqual(data['related_roles'], ['webserver', 'worker'])
+
+    def test_env_caches_known_environments(self):
+        """Should only cache the links and dependencies of known
+        environments
+
+        """
+        chef.invalidate_snapshot()
+        snapshot = chef.get_snapshot()
+        self.assertTrue(graphs.get_env_links(snapshot, 'production') is
+                        graphs.get_env_links(snapshot, 'production'))
+        graphs.get_dependency_index(snapshot, 'production')
+        for i in range(3):
+            env = 'unknown{0}'.format(i)
+            self.assertEqual(graphs.get_env_links(snapshot, env).links, {})
+            self.assertEqual(graphs.get_dependency_index(snapshot, env).search(
+                role='dbserver'), {'nodes': [], 'roles': []})
+        self.assertEqual(sorted(snapshot._cache),
+                         [('dependency_index', 'production'),
+                          ('env_links', 'production')])
+
     def test_get_role_relations_empty_when_roles(self):
         """Should obtain no roles when the given roles have no extra relationships"""
         stag_nodes = chef.filter_nodes(self.nodes, 'staging')
@@ -468,6 +995,33 @@ class TestAPI(TestCase):
         self.assertEqual(data[0]['chef_environment'], 'staging')
         self.assertEqual(data[0]['role'], ['webserver'])
 
+    def _ndjson(self, resp):
+        if getattr(resp, 'streaming', False):
+            content = ''.join(resp.streaming_content)
+        else:
+            content = resp.content
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_get_nodes_ndjson(self):
+        """Should stream one node per line when format=ndjson is given"""
+        resp = self.client.get("/api/nodes/?format=ndjson")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], "application/x-ndjson")
+        data = self._ndjson(resp)
+        self.assertEqual(len(data), TOTAL_NODES)
+        resp = self.client.get("/api/nodes")
+        self.assertEqual(data, json.loads(resp.content))
+
+    def test_get_nodes_ndjson_extended_env_filter(self):
+        """Should stream filtered extended nodes when filters are given"""
+        resp = self.client.get(
+            "/api/nodes/?format=ndjson&env=staging&extended=true")
+        self.assertEqual(resp.status_code, 200)
+        data = self._ndjson(resp)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['chef_environment'], 'staging')
+        self.assertEqual(data[0]['role'], ['webserver'])
+
     def test_get_node(self):
         """Should return a node hash when node name is found"""
         resp = self.client.get("/api/nodes/testnode6")
@@ -482,6 +1036,290 @@ class TestAPI(TestCase):
         resp = self.client.get("/api/nodes/node_does_not_exist")
         self.assertEqual(resp.status_code, 404)
 
+    def test_get_graph(self):
+        """Should return the graph of an environment in JSON format"""
+        resp = self.client.get("/api/graph?env=production")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual([cluster['name'] for cluster in data['clusters']],
+                         ['dbserver', 'loadbalancer', 'webserver', 'worker',
+                          'none'])
+        self.assertEqual(len(data['nodes']), 5)
+        self.assertEqual(data['nodes'][0]['cluster'], 'loadbalancer')
+        self.assertEqual(data['nodes'][0]['label'], 'testnode1\nloadbalancer')
+        self.assertEqual(len(data['edges']), 5)
+        self.assertTrue({'source': 'testnode8', 'target':
+                         'testnode3.mydomain.com', 'label': 'mysql',
+                         'type': 'needs'} in data['edges'])
+        self.assertEqual(data['related_roles'], [])
+
+    def test_get_graph_roles(self):
+        """Should return the graph of the given roles with their related
+        roles, and hide host names when asked to
+
+        """
+        resp = self.client.get(
+            "/api/graph?env=production&roles=dbserver&show_hostnames=0")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual([node['label'] for node in data['nodes']],
+                         ['dbserver'])
+        self.assertEqual(data['edges'], [])
+        self.assertEqual(data['related_roles'], ['webserver', 'worker'])
+
+    def test_get_graph_cache_bounded(self):
+        """Should keep serialized graphs in the bounded graph cache"""
+        with patch.object(api, 'graph_cache', fragments.FragmentCache(600)):
+            for i in range(5):
+                resp = self.client.get(
+                    "/api/graph?env=production&roles=role{0}".format(i))
+                self.assertEqual(resp.status_code, 200)
+            self.assertTrue(0 < len(api.graph_cache) < 5)
+            self.assertTrue(api.graph_cache.size <= 600)
+
+    def test_get_graph_no_env(self):
+        """Should return BAD REQUEST when no environment is given"""
+        resp = self.client.get("/api/graph")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_dependencies(self):
+        """Should return the nodes and roles depending on a role"""
+        resp = self.client.get(
+            "/api/dependencies?env=production&role=dbserver")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['roles'],
+                         ['loadbalancer', 'webserver', 'worker'])
+        self.assertEqual(
+            [(node['name'], node['distance']) for node in data['nodes']],
+            [('testnode2', 1), ('testnode7', 1), ('testnode8', 1),
+             ('testnode1', 2)])
+
+    def test_get_dependencies_upstream(self):
+        """Should return the nodes and roles a node depends on"""
+        resp = self.client.get("/api/dependencies?env=production&"
+                               "node=testnode1&direction=upstream")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['roles'], ['dbserver', 'webserver'])
+        self.assertEqual(data['nodes'][-1], {
+            'name': 'testnode3.mydomain.com', 'role': 'dbserver',
+            'distance': 2})
+
+    def test_get_dependencies_bad_request(self):
+        """Should return BAD REQUEST when the query is incomplete"""
+        resp = self.client.get("/api/dependencies?env=production")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get("/api/dependencies?env=production&"
+                               "role=dbserver&direction=sideways")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_rows(self):
+        """Should return a page of list rows for the filtered nodes"""
+        resp = self.client.get("/api/rows?env=&virt=&sEcho=3&"
+                               "iDisplayStart=2&iDisplayLength=3")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEqual(data['sEcho'], 3)
+        self.assertEqual(data['iTotalRecords'], TOTAL_NODES)
+        self.assertEqual(data['iTotalDisplayRecords'], TOTAL_NODES)
+        names = [node['name'] for node in chef.get_nodes()][2:5]
+        self.assertEqual([row[1] for row in data['aaData']], names)
+        snapshot = chef.get_snapshot()
+        self.assertEqual(data['digests'],
+                         [snapshot.get_node_digest(name) for name in names])
+        row = data['aaData'][names.index('testnode3.mydomain.com')]
+        self.assertEqual(row[4], 'production')
+        self.assertEqual(row[5], 'dbserver')
+        self.assertEqual(row[6], '')  # No recipes in its run_list
+        self.assertEqual(row[7], '<a href="#" class="btn btn-small '
+                                 'btn-custom  disabled">Special3</a>')
+
+    def test_get_rows_all(self):
+        """Should return all rows when every row is requested"""
+        for length in ['-1', '0']:
+            with patch.object(rows, 'MAX_PAGE_LENGTH', 3):
+                resp = self.client.get(
+                    "/api/rows?env=&virt=&iDisplayLength=" + length)
+            data = json.loads(resp.content)
+            self.assertEqual(len(data['aaData']), TOTAL_NODES)
+        with patch.object(rows, 'MAX_PAGE_LENGTH', 3):
+            resp = self.client.get("/api/rows?env=&virt=&iDisplayLength=5")
+        self.assertEqual(len(json.loads(resp.content)['aaData']), 3)
+
+    def test_get_rows_same_as_list(self):
+        """Should return the cells of the rows the list view renders"""
+        fragments.row_cache.clear()
+        nodes = chef.get_snapshot().nodes_extended
+        page = fragments.render_rows('list_row.html', nodes, SHOW_LINKS)
+        resp = self.client.get("/api/rows?env=&virt=&iDisplayLength=-1")
+        data = json.loads(resp.content)
+        for row in data['aaData']:
+            for cell in row[1:]:
+                self.assertTrue(cell in page, cell)
+        self.assertEqual(len(fragments.row_cache), TOTAL_NODES)
+
+    def test_get_rows_filter_search_sort(self):
+        """Should filter, search and sort rows"""
+        resp = self.client.get("/api/rows?env=production&virt=guest&"
+                               "sSearch=WEBSERVER&iSortingCols=1&"
+                               "iSortCol_0=2&sSortDir_0=desc")
+        data = json.loads(resp.content)
+        self.assertEqual(data['iTotalRecords'], 5)
+        self.assertEqual(data['iTotalDisplayRecords'], 2)
+        self.assertEqual([row[1] for row in data['aaData']],
+                         ['testnode7', 'testnode2'])
+
+    def test_get_rows_escaped(self):
+        """Should escape node values in list rows"""
+        node = {'name': '<b>', 'tags': ['<i>'], 'run_list': []}
+        node.update(display=NodeDisplay(node), digest='escaped')
+        cells = rows.render_cells([node])[0]
+        self.assertEqual(cells[1], '&lt;b&gt;')
+        self.assertTrue('>&lt;i&gt;</a>' in cells[7])
+
+    def test_get_node_details(self):
+        """Should return a plain node, cached for long when requested with
+        its current digest
+
+        """
+        digest = chef.get_snapshot().get_node_digest('testnode2')
+        resp = self.client.get("/api/details/testnode2?v=" + digest)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content), chef.get_node('testnode2'))
+        self.assertEqual(resp['ETag'], '"{0}"'.format(digest))
+        self.assertEqual(resp['Cache-Control'], 'public, max-age=31536000')
+        resp = self.client.get("/api/details/testnode2?v=" + digest,
+                               HTTP_IF_NONE_MATCH='"{0}"'.format(digest))
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_node_details_other_digest(self):
+        """Should not cache node details requested with an old digest"""
+        resp = self.client.get("/api/details/testnode2?v=old")
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('Cache-Control'))
+        resp = self.client.get("/api/details/testnode3.mydomain.com")
+        self.assertEqual(json.loads(resp.content)['name'],
+                         'testnode3.mydomain.com')
+
+    def test_get_node_details_not_found(self):
+        """Should return a 404 for nodes that don't exist"""
+        resp = self.client.get("/api/details/node_does_not_exist")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_etag(self):
+        """Should answer with a 304 when the ETag is still current"""
+        resp = self.client.get("/api/roles")
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        resp = self.client.get("/api/roles", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], etag)
+        self.assertEqual(resp.content, '')
+
+    def test_api_etag_params(self):
+        """Should give a different ETag to different request parameters"""
+        etag = self.client.get("/api/nodes?env=production")['ETag']
+        resp = self.client.get("/api/nodes?env=staging",
+                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    def test_api_etag_new_generation(self):
+        """Should answer with the new data after the repo changes"""
+        generation = chef.get_repo_generation()[:2]
+        with patch('kitchen.dashboard.conditional.get_repo_generation',
+                   lambda: generation + (1000000000.0,)):
+            etag = self.client.get("/api/roles")['ETag']
+        with patch('kitchen.dashboard.conditional.get_repo_generation',
+                   lambda: generation + (1000000060.0,)):
+            resp = self.client.get("/api/roles", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    @patch('kitchen.dashboard.conditional.get_repo_generation',
+           lambda: ('repo', 'head', 1000000000.0))
+    def test_api_if_modified_since(self):
+        """Should answer with a 304 when not modified since the given date"""
+        resp = self.client.get("/api/roles")
+        self.assertEqual(resp['Last-Modified'],
+                         'Sun, 09 Sep 2001 01:46:40 GMT')
+        resp = self.client.get("/api/roles",
+                               HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get("/api/roles", HTTP_IF_MODIFIED_SINCE=
+                               'Sun, 09 Sep 2001 01:46:00 GMT')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_api_etag_not_loaded(self):
+        """Should not load any repo data when answering with a 304"""
+        etag = self.client.get("/api/nodes")['ETag']
+        with patch('kitchen.backends.lchef.get_snapshot') as get_snapshot:
+            resp = self.client.get("/api/nodes", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse(get_snapshot.called)
+
+
+class TestFragments(TestCase):
+
+    def setUp(self):
+        fragments.row_cache.clear()
+
+    def test_cache_evicts_least_recently_used(self):
+        """Should evict the least recently used fragments when full"""
+        cache = fragments.FragmentCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.set('c', 'cccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.size, 8)
+        cache.set('a', 'aa')
+        self.assertEqual(cache.size, 6)
+        cache.set('d', 'd' * 11)  # Bigger than the cache
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_render_rows_cached(self):
+        """Should only render rows not found in the cache"""
+        nodes = chef.get_snapshot().nodes_extended
+        html = fragments.render_rows('list_row.html', nodes, True)
+        self.assertEqual(html.count('<tr '), TOTAL_NODES)
+        self.assertEqual(len(fragments.row_cache), TOTAL_NODES)
+        with patch.object(fragments, 'get_template') as mock_method:
+            self.assertEqual(
+                fragments.render_rows('list_row.html', nodes, True), html)
+            self.assertFalse(mock_method.called)
+
+    def test_render_rows_settings(self):
+        """Should render rows again when the settings they depend on change
+        """
+        nodes = chef.get_snapshot().nodes_extended[:2]
+        with patch.object(chef, 'plugins', {}):
+            with_links = fragments.render_rows('list_row.html', nodes, True)
+            without_links = fragments.render_rows('list_row.html', nodes,
+                                                  False)
+        self.assertNotEqual(with_links, without_links)
+        self.assertEqual(len(fragments.row_cache), 4)
+        with patch.object(chef, 'plugins',
+                          plugins.import_plugins(['monitoring'])):
+            fragments.render_rows('list_row.html', nodes, True)
+        self.assertEqual(len(fragments.row_cache), 6)
+
+    def test_render_rows_changed_node(self):
+        """Should render the rows of changed nodes"""
+        node = {'name': 'testnode', 'tags': ['WIP'], 'run_list': []}
+        record = NodeRecord(json.dumps(node))
+        self.assertTrue('>WIP</a>' in
+                        fragments.render_rows('list_row.html', [record], True))
+        node['tags'] = ['dummy']
+        record = NodeRecord(json.dumps(node))
+        html = fragments.render_rows('list_row.html', [record], True)
+        self.assertTrue('>dummy</a>' in html)
+        self.assertFalse('>WIP</a>' in html)
+
 
 class TestTemplateTags(TestCase):
     run_list = [
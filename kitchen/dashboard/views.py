@@ -1,28 +1,32 @@
 """Dashboard app views"""
 import os
 import time
-import json
 
-from django.contrib.messages import add_message, ERROR, WARNING
+from django.contrib.messages import add_message, ERROR, WARNING, INFO
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.http import Http404, HttpResponse
 from logbook import Logger
 
-from kitchen.backends.lchef import (get_nodes, get_nodes_extended, get_roles,
-                                    get_role_groups, get_environments,
-                                    filter_nodes, group_nodes_by_host,
-                                    inject_plugin_data, RepoError,
-                                    plugins as PLUGINS)
-from kitchen.dashboard import graphs
+from kitchen.backends.lchef import (get_snapshot, filter_nodes,
+                                    expand_nodes, with_plugin_data,
+                                    RepoError, plugins as PLUGINS)
+from kitchen.dashboard import graphs, fragments
+from kitchen.dashboard.conditional import repo_condition
 from kitchen.settings import (SHOW_VIRT_VIEW, SHOW_LIST_VIEW, SHOW_GRAPH_VIEW,
-                              SHOW_HOST_NAMES, SHOW_LINKS, REPO, SYNCDATE_FILE)
+                              SHOW_HOST_NAMES, SHOW_LINKS, REPO, SYNCDATE_FILE,
+                              GRAPH_LAYOUTS, GRAPH_COLLAPSE_THRESHOLD,
+                              LIST_SERVER_SIDE_THRESHOLD)
 
 log = Logger(__name__)
 
 
-def _get_data(request, env, roles, virt, group_by_host=False):
-    """Returns processed repository data, filtering nodes based on given args
+def _get_data(request, env, roles, virt, group_by_host=False,
+              server_side=False, plugin_data=True):
+    """Returns processed repository data, filtering nodes based on given args.
+    With server_side, nodes are left out, to be requested page by page.
+    Without plugin_data, kitchen plugin data is left to be injected when
+    rows are rendered
     """
     roles = [role for role in roles.split(',') if role]
     data = {
@@ -31,43 +35,63 @@ def _get_data(request, env, roles, virt, group_by_host=False):
         'show_graph': SHOW_GRAPH_VIEW, 'show_links': SHOW_LINKS,
         'query_string': request.META['QUERY_STRING']
     }
-    data['roles'] = get_roles()
-    roles_groups = get_role_groups(data['roles'])
-    data['roles_groups'] = roles_groups
+    snapshot = get_snapshot()
+    data['roles'] = snapshot.roles
+    data['roles_groups'] = snapshot.role_groups
     data['virt_roles'] = ['host', 'guest']
-    # Get environments before we filter nodes
-    data['nodes'] = get_nodes()
-    data['nodes_extended'] = get_nodes_extended(data['nodes'])
-    data['environments'] = get_environments(data['nodes_extended'])
+    data['nodes_extended'] = snapshot.nodes_extended
+    data['environments'] = snapshot.environments
+    if server_side:
+        data['server_side'] = True
+        data['nodes_extended'] = []
+        return data
+    topology = None
     if group_by_host:
-        data['nodes_extended'] = group_nodes_by_host(data['nodes_extended'],
-                                                     roles=data['filter_roles'],
-                                                     env=data['filter_env'])
+        topology = snapshot.topology
+        data['nodes_extended'] = topology.group(
+            roles=data['filter_roles'], env=data['filter_env'])
     elif data['filter_env'] or data['filter_roles'] or data['filter_virt']:
-        data['nodes_extended'] = filter_nodes(data['nodes_extended'],
-                                              data['filter_env'],
-                                              data['filter_roles'],
-                                              data['filter_virt'])
-    inject_plugin_data(data['nodes_extended'])
+        data['nodes_extended'] = snapshot.filter_nodes(data['filter_env'],
+                                                       data['filter_roles'],
+                                                       data['filter_virt'])
+    if plugin_data:
+        data['nodes_extended'] = with_plugin_data(data['nodes_extended'],
+                                                  topology)
     if not data['nodes_extended']:
         add_message(request, WARNING,
                     "There are no nodes that fit the supplied criteria.")
     return data
 
 
-def _show_repo_sync_date(request):
-    """Shows the sync date, which will be the modified date of a file"""
+def _get_sync_age():
+    """Returns the minutes passed since the last sync when it is getting old,
+    0 when it is recent and None when the sync date can't be read
+
+    """
     try:
         sync_age = (time.time() - os.stat(SYNCDATE_FILE).st_mtime) / 60
     except OSError:
+        return None
+    sync_lim = REPO['SYNC_PERIOD'] * 2.5
+    if sync_age > sync_lim:
+        return int(sync_age)
+    return 0
+
+
+def _show_repo_sync_date(request):
+    """Shows the sync date, which will be the modified date of a file"""
+    sync_age = _get_sync_age()
+    if sync_age is None:
         add_message(request, ERROR, "There have been errors while "
                                     "syncing the repo")
-    else:
-        sync_lim = REPO['SYNC_PERIOD'] * 2.5
-        if sync_age > sync_lim:
-            add_message(request, WARNING, "The {0} repo is getting out of "
-                        "sync. Last pull was {1} minutes "
-                        "ago.".format(REPO['NAME'], int(sync_age)))
+    elif sync_age:
+        add_message(request, WARNING, "The {0} repo is getting out of "
+                    "sync. Last pull was {1} minutes "
+                    "ago.".format(REPO['NAME'], sync_age))
+
+
+# Pages also depend on the sync date warning they show
+page_condition = repo_condition(lambda request: _get_sync_age())
 
 
 def _set_options(options):
@@ -80,25 +104,30 @@ def _set_options(options):
     return options
 
 
+@page_condition
 def list(request):
     """Default list view showing a list of nodes"""
     _show_repo_sync_date(request)
     data = {}
     try:
+        server_side = (LIST_SERVER_SIDE_THRESHOLD and
+                       len(get_snapshot().nodes) > LIST_SERVER_SIDE_THRESHOLD)
         data = _get_data(request,
                          request.GET.get('env', REPO['DEFAULT_ENV']),
                          request.GET.get('roles', ''),
-                         request.GET.get('virt', REPO['DEFAULT_VIRT']))
+                         request.GET.get('virt', REPO['DEFAULT_VIRT']),
+                         server_side=server_side, plugin_data=False)
     except RepoError as e:
         add_message(request, ERROR, str(e))
-        data['NODES'] = []
     else:
-        data['NODES'] = json.dumps(data['nodes'])
+        data['rows'] = fragments.render_rows(
+            'list_row.html', data['nodes_extended'], data['show_links'])
     data['view'] = 'list'
     return render_to_response('list.html',
                               data, context_instance=RequestContext(request))
 
 
+@page_condition
 def virt(request):
     """Displays a view where the nodes are grouped by physical host"""
     _show_repo_sync_date(request)
@@ -108,17 +137,20 @@ def virt(request):
                          request.GET.get('env', REPO['DEFAULT_ENV']),
                          request.GET.get('roles', ''),
                          request.GET.get('virt', REPO['DEFAULT_VIRT']),
-                         group_by_host=True)
+                         group_by_host=True, plugin_data=False)
     except RepoError as e:
         add_message(request, ERROR, str(e))
-        data['NODES'] = []
     else:
-        data['NODES'] = json.dumps(data['nodes'])
+        data['rows'] = fragments.render_rows(
+            'virt_host.html', data['nodes_extended'], data['show_links'],
+            digest_field='block_digest', topology=get_snapshot().topology)
     data['view'] = 'virt'
     return render_to_response('virt.html',
                               data, context_instance=RequestContext(request))
 
 
+# Not conditional: a graph file can be evicted from the graph cache while the
+# repository is unchanged, and a 304 would keep showing it
 def graph(request):
     """Graph view where users can visualize graphs of their nodes
     generated using Graphviz open source graph visualization library
@@ -129,36 +161,56 @@ def graph(request):
     options = _set_options(request.GET.get('options'))
     env_filter = request.GET.get('env', REPO['DEFAULT_ENV'])
     roles_filter = [role for role in request.GET.get('roles', '').split(',') if role]
+    layout = request.GET.get('layout', GRAPH_LAYOUTS[0])
+    if layout not in GRAPH_LAYOUTS:
+        layout = GRAPH_LAYOUTS[0]
+    collapse = 'collapse_roles' in options
     env_nodes = []
     try:
-        data = _get_data(request, env_filter, '', 'guest')
+        data = _get_data(request, env_filter, '', 'guest', plugin_data=False)
     except RepoError as e:
         add_message(request, ERROR, str(e))
     else:
         if env_filter:
+            # Graphs only read node names and roles, while links are built
+            # out of any node attribute, once per environment and snapshot
             env_nodes = data['nodes_extended']
+            env_links = graphs.get_env_links(get_snapshot(), env_filter)
             if roles_filter:
                 # Filter the env nodes by role
                 data['nodes_extended'] = filter_nodes(data['nodes_extended'],
                                                       roles=roles_filter)
                 data['filter_roles'] = roles_filter
+            if not collapse and graphs.collapse_roles(data['nodes_extended']):
+                collapse = True
+                add_message(request, INFO, "Nodes are grouped by role in "
+                            "graphs of more than {0} nodes".format(
+                                GRAPH_COLLAPSE_THRESHOLD))
             success, msg = graphs.generate_node_map(
                 data['nodes_extended'], data.get('roles', []),
-                'show_hostnames' in options)
+                'show_hostnames' in options, env_links=env_links,
+                collapse=collapse, prog=layout)
             data['draw_graph'] = success
             if not success:
                 add_message(request, ERROR, msg)
             else:
-                data['related_roles'] = graphs.get_role_relations(env_filter,
-                                                                  roles_filter,
-                                                                  env_nodes)
+                data['graph_url'] = graphs.get_graph_url(msg)
+                data['related_roles'] = graphs.get_role_relations(
+                    env_filter, roles_filter, env_nodes, env_links)
         else:
             add_message(request, WARNING, "Please select an environment")
 
     data['show_hostnames'] = 'show_hostnames' in options
+    data['collapse_roles'] = collapse
+    data['layouts'] = GRAPH_LAYOUTS
+    data['layout'] = layout
     data['view'] = 'graph'
-    return render_to_response('graph.html',
-                              data, context_instance=RequestContext(request))
+    response = render_to_response(
+        'graph.html', data, context_instance=RequestContext(request))
+    if not data.get('draw_graph', True):
+        # Don't let clients keep a failed render
+        response['Cache-Control'] = 'no-store'
+    return response
 
 
 def plugins(request, name, method, plugin_type='list'):
@@ -177,16 +229,17 @@ def plugins(request, name, method, plugin_type='list'):
     if not getattr(func, '__is_view__', False):
         raise Http404("Plugin method '{0}.{1}' ""is not defined "
                       "as a view".format(name, method))
-    nodes = get_nodes()
-    nodes = get_nodes_extended(nodes)
+    snapshot = get_snapshot()
     if plugin_type in ('v', 'virt'):
         if func.__p_type__ != 'virt':
             raise Http404("Plugin '{0}.{1}' has wrong "
                           "type".format(name, method))
-        nodes = group_nodes_by_host(nodes, roles=None)
+        nodes = snapshot.topology.expand(snapshot.topology.hosts)
     elif func.__p_type__ != 'list':
         raise Http404("Plugin '{0}.{1}' has wrong type".format(name, method))
-    inject_plugin_data(nodes)
+    else:
+        nodes = expand_nodes(snapshot.nodes_extended)
+    nodes = with_plugin_data(nodes)
     try:
         result = func(request, nodes)
     except TypeError:
@@ -33,11 +33,42 @@ SHOW_LIST_VIEW = True
 SHOW_GRAPH_VIEW = True
 SHOW_HOST_NAMES = True
 SHOW_LINKS = True
+# Repositories with more nodes are listed one page at a time, sorted and
+# searched by the server. Disabled when 0
+LIST_SERVER_SIDE_THRESHOLD = 2000
+# Maximum size, in characters, of the node rows kept rendered
+ROW_CACHE_MAX_SIZE = 20*1024*1024
 
 ENABLE_PLUGINS = []
 
 LOG_FILE = '/tmp/kitchen.log'
 SYNCDATE_FILE = '/tmp/kitchen-syncdate'
+# Written by repo_sync.py, loaded by the web workers after each sync. It must
+# be in a directory only the kitchen user can write to
+SNAPSHOT_FILE = os.path.join(REPO_BASE_PATH, '.kitchen-snapshot')
+# Optional SQLite node store written by repo_sync.py, used to answer node
+# queries without loading all nodes. Disabled when empty
+NODE_STORE_FILE = ''
+# Rendered graphs are cached under this directory of STATIC_ROOT. The oldest
+# renders are evicted when the cache exceeds the size (bytes) or age
+# (seconds) limits
+GRAPH_CACHE_DIR = os.path.join('img', 'graphs')
+GRAPH_CACHE_MAX_SIZE = 50 * 1024 * 1024
+GRAPH_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# Maximum number of graphviz processes rendering graphs at once
+GRAPH_MAX_RENDERS = 2
+# Build graphs with pydot objects instead of writing their DOT source directly
+GRAPH_USE_PYDOT = False
+# Render the graph of every environment after each sync
+GRAPH_PRERENDER = True
+# Graphviz layout programs selectable in the graph view, the first one being
+# the default. sfdp scales best to very large graphs
+GRAPH_LAYOUTS = ['dot', 'sfdp', 'neato', 'fdp', 'twopi', 'circo']
+# Graphs of more nodes than this are drawn with one vertex per role.
+# Disabled when 0
+GRAPH_COLLAPSE_THRESHOLD = 1000
+# Maximum size, in characters, of the graph API responses kept serialized
+GRAPH_JSON_CACHE_MAX_SIZE = 10*1024*1024
 ###################
 
 ADMINS = ()
@@ -23,8 +23,12 @@ urlpatterns = patterns('',
     (r'^graph/$', 'kitchen.dashboard.views.graph'),
     (r'^plugins/((?P<plugin_type>(virt|v|list|l))/)?(?P<name>[\w\-\_]+)/(?P<method>\w+)/?$', 'kitchen.dashboard.views.plugins'),
     (r'^api/nodes/(?P<name>\w+)$', api.get_node),
+    (r'^api/details/(?P<name>[^/]+)$', api.get_node_details),
     (r'^api/nodes', api.get_nodes),
     (r'^api/roles', api.get_roles),
+    (r'^api/graph', api.get_graph),
+    (r'^api/dependencies', api.get_dependencies),
+    (r'^api/rows', api.get_rows),
     (r'^404', TemplateView.as_view(template_name="404.html")),
 )
 